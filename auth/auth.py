@@ -7,9 +7,19 @@ __author__ = 'Usachev'
 from rest_framework import authentication
 from rest_framework import exceptions
 from Api.models import User
+from togetherapi.auth.cache import token_cache, connect_signals as connect_token_signals
+from togetherapi.auth.writer import user_writer
+from togetherapi.notifications.devices import connect_signals as connect_device_signals
+from togetherapi.notifications.unread import connect_signals as connect_unread_signals
 
 logger = get_custom_logger()
 
+# every Api process imports the authentication, user changes made there must reach the token caches of
+# all workers, device registrations the APNS token cache and new messages the unread counters
+connect_token_signals()
+connect_device_signals()
+connect_unread_signals()
+
 
 class CustomAuthentication(authentication.BaseAuthentication):
     def authenticate(self, request):
@@ -19,13 +29,20 @@ class CustomAuthentication(authentication.BaseAuthentication):
             raise exceptions.AuthenticationFailed('Token not present')
         else:
             # logger.debug('Incoming token: ' + token)
+            if token_cache.is_unknown(token):
+                raise exceptions.AuthenticationFailed('User with token %s were not found' % token)
             try:
-                user = User.objects.get(UserToken=token)
+                user = token_cache.get_user(token)
+                if user is None:
+                    invalidations = token_cache.invalidations
+                    user = User.objects.get(UserToken=token)
+                    token_cache.set_user(token, user)
                 if user.UserEnabled:
                     return user, token
                 elif user.UserEnabled is None:
+                    # persisted later in bulk, see migrate_user_enabled for a one-shot migration
                     user.UserEnabled = True
-                    user.save()
+                    user_writer.update(user, 'UserEnabled', True, when_unset=True)
                     return user, token
                 else:
                     # logger.error('User account is disabled')
@@ -35,4 +52,5 @@ class CustomAuthentication(authentication.BaseAuthentication):
                 raise exceptions.AuthenticationFailed('User token %s is ambiguous.' % token)
             except DoesNotExist:
                 # logger.error('Token not found')
+                token_cache.remember_unknown(token, invalidations)
                 raise exceptions.AuthenticationFailed('User with token %s were not found' % token)
@@ -0,0 +1,177 @@
+import copy
+import os
+import re
+import threading
+from time import sleep
+
+import redis
+from mongoengine import signals
+
+from Api.models import User
+from togetherapi import settings
+from togetherapi.helpers import TTLCache
+from togetherapi.utils import get_custom_logger
+
+__author__ = 'Usachev'
+
+logger = get_custom_logger()
+
+TOKEN_CACHE_SIZE = getattr(settings, 'TOKEN_CACHE_SIZE', 10000)
+TOKEN_CACHE_TTL = getattr(settings, 'TOKEN_CACHE_TTL', 300)
+TOKEN_INVALIDATION_CHANNEL = getattr(settings, 'TOKEN_INVALIDATION_CHANNEL', 'auth_token_invalidation')
+UNKNOWN_TOKEN_CACHE_SIZE = getattr(settings, 'UNKNOWN_TOKEN_CACHE_SIZE', 100000)
+UNKNOWN_TOKEN_CACHE_TTL = getattr(settings, 'UNKNOWN_TOKEN_CACHE_TTL', 60)
+# printable ASCII without whitespace, anything else can not have been issued by us
+TOKEN_PATTERN = re.compile(getattr(settings, 'TOKEN_PATTERN', r'^[\x21-\x7e]{1,256}$'))
+
+
+class TokenCache(TTLCache):
+    def __init__(self, max_size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL, channel=TOKEN_INVALIDATION_CHANNEL,
+                 document=User):
+        """
+        Token to user cache which is kept coherent across worker processes through Redis pub/sub.
+        Users are kept as raw documents and rebuilt for every lookup, a document shared between
+        concurrent requests would leak the unsaved changes of one request into the others.
+        :param channel: channel carrying tokens which must be evicted in every worker
+        :param document: document class the cached users are rebuilt as
+        """
+        super(TokenCache, self).__init__(max_size, ttl)
+        self.channel = channel
+        self.document = document
+        self.unknown = TTLCache(UNKNOWN_TOKEN_CACHE_SIZE, UNKNOWN_TOKEN_CACHE_TTL)
+        self.invalidations = 0
+        self.redis = redis.Redis()
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._ensure_listener()
+        return super(TokenCache, self).get(key, default)
+
+    def get_user(self, token):
+        """
+        :return: a fresh document of the user owning the token or None
+        """
+        son = self.get(token)
+        if son is None:
+            return None
+        return self.document._from_son(copy.deepcopy(son))
+
+    def set_user(self, token, user):
+        self.set(token, user.to_mongo())
+
+    def is_unknown(self, token):
+        """
+        Tells whether the token can be rejected without a database lookup
+        """
+        if not TOKEN_PATTERN.match(token):
+            return True
+        self._ensure_listener()
+        return self.unknown.get(token, False)
+
+    def remember_unknown(self, token, since=None):
+        """
+        :param since: invalidations counted before the lookup which missed. An invalidation received
+        in between may be the token being issued, the miss is not remembered then.
+        """
+        if since is not None and since != self.invalidations:
+            return
+        self.unknown.set(token, True)
+
+    def evict(self, token):
+        self.invalidations += 1
+        self.discard(token)
+        self.unknown.discard(token)
+
+    def invalidate(self, token):
+        """
+        Evicts the token in this process and publishes the eviction to every other worker.
+        Must be called whenever a user gets disabled, its token is rotated or a new token is issued,
+        the latter drops the token from the unknown tokens set so it is never rejected falsely.
+        """
+        self.evict(token)
+        try:
+            self.redis.publish(self.channel, token)
+        except redis.RedisError, e:
+            logger.error('Unable to publish token invalidation: %s' % e)
+
+    def _ensure_listener(self):
+        # the listener thread does not survive a fork, so it is started once per process
+        if self._listener_pid == os.getpid():
+            return
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            # entries inherited from the parent process could have missed invalidations
+            self.clear()
+            self.unknown.clear()
+            listener = threading.Thread(target=self._listen, name='token-cache-invalidation')
+            listener.daemon = True
+            listener.start()
+            self._listener_pid = os.getpid()
+
+    def _listen(self):
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                pubsub.subscribe(self.channel)
+                for item in pubsub.listen():
+                    if item['type'] == 'message':
+                        self.evict(item['data'])
+            except redis.RedisError, e:
+                logger.error('Token invalidation listener failed: %s' % e)
+            finally:
+                pubsub.close()
+            # invalidations published while disconnected are lost, so nothing cached can be trusted
+            self.clear()
+            self.unknown.clear()
+            sleep(1)
+
+
+token_cache = TokenCache()
+
+
+def invalidate_token(token):
+    token_cache.invalidate(token)
+
+
+def token_issued(token):
+    token_cache.invalidate(token)
+
+
+def _user_saving(sender, document, **kwargs):
+    # the token a rotated one replaces can only be read before the save
+    if document.pk is not None and 'UserToken' in document._get_changed_fields():
+        document._previous_token = sender.objects(pk=document.pk).scalar('UserToken').first()
+
+
+def _user_saved(sender, document, created=False, **kwargs):
+    rotated = '_previous_token' in document.__dict__
+    previous = document.__dict__.pop('_previous_token', None)
+    if previous:
+        invalidate_token(previous)
+    if not document.UserToken:
+        return
+    if created or rotated:
+        token_issued(document.UserToken)
+    else:
+        invalidate_token(document.UserToken)
+
+
+def _user_deleted(sender, document, **kwargs):
+    if document.UserToken:
+        invalidate_token(document.UserToken)
+
+
+def connect_signals():
+    """
+    Evicts the tokens of every saved or deleted user in all workers, so a disabled user or a rotated
+    token stops authenticating right away. Users are changed by the Api processes, so it has to be
+    called there. Queryset updates send no signal, their changes show up once TOKEN_CACHE_TTL expires.
+    """
+    if signals.signals_available:
+        signals.pre_save.connect(_user_saving, sender=User)
+        signals.post_save.connect(_user_saved, sender=User)
+        signals.post_delete.connect(_user_deleted, sender=User)
+    else:
+        logger.error('blinker is not installed, cached tokens are only evicted by their TTL')
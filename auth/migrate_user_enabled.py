@@ -0,0 +1,22 @@
+"""
+One-shot migration which enables every user created before the UserEnabled field existed.
+Once it has run, authentication never has to fill the field in lazily.
+
+Usage: DJANGO_SETTINGS_MODULE=togetherapi.settings python -m togetherapi.auth.migrate_user_enabled
+"""
+from Api.models import User
+from togetherapi.utils import get_custom_logger
+
+__author__ = 'Usachev'
+
+logger = get_custom_logger()
+
+
+def migrate_user_enabled():
+    updated = User.objects(UserEnabled=None).update(set__UserEnabled=True)
+    logger.debug('UserEnabled migration updated %d users' % updated)
+    return updated
+
+
+if __name__ == '__main__':
+    print 'Users enabled: %d' % migrate_user_enabled()
@@ -0,0 +1,85 @@
+import atexit
+import os
+import threading
+from collections import defaultdict
+
+from Api.models import User
+from togetherapi import settings
+from togetherapi.utils import get_custom_logger
+
+__author__ = 'Usachev'
+
+logger = get_custom_logger()
+
+USER_WRITER_INTERVAL = getattr(settings, 'USER_WRITER_INTERVAL', 5)
+USER_WRITER_MAX_BATCH = getattr(settings, 'USER_WRITER_MAX_BATCH', 1000)
+
+
+class BatchedUserWriter(object):
+    def __init__(self, interval=USER_WRITER_INTERVAL, max_batch=USER_WRITER_MAX_BATCH):
+        """
+        Collects single field updates of users and writes them with one bulk update per field value
+        :param interval: seconds between two flushes of the background thread
+        :param max_batch: number of pending users which triggers an early flush
+        """
+        self.interval = interval
+        self.max_batch = max_batch
+        self.flushed = 0
+        self._pending = defaultdict(set)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._flusher_pid = None
+        atexit.register(self.flush)
+
+    def update(self, user, field, value, when_unset=False):
+        """
+        Schedules `field` of the user to be set to `value`
+        :param when_unset: only write documents where the field is still unset, so a concurrent
+        explicit change made elsewhere is never overwritten by a deferred write
+        """
+        self._ensure_flusher()
+        with self._lock:
+            # the latest scheduled value of a field wins
+            for key, ids in self._pending.items():
+                if key[0] == field and key[1] != value:
+                    ids.discard(user.id)
+            self._pending[(field, value, when_unset)].add(user.id)
+            pending = sum(len(ids) for ids in self._pending.values())
+        if pending >= self.max_batch:
+            self._wakeup.set()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(set)
+        for (field, value, when_unset), ids in pending.items():
+            if not ids:
+                continue
+            query = {'id__in': list(ids)}
+            if when_unset:
+                query[field] = None
+            try:
+                updated = User.objects(**query).update(**{'set__%s' % field: value})
+                self.flushed += updated
+                logger.debug('%d users updated with %s=%s' % (updated, field, value))
+            except BaseException, e:
+                logger.error('Bulk update of %s failed: %s' % (field, e))
+
+    def _ensure_flusher(self):
+        if self._flusher_pid == os.getpid():
+            return
+        with self._lock:
+            if self._flusher_pid == os.getpid():
+                return
+            flusher = threading.Thread(target=self._run, name='batched-user-writer')
+            flusher.daemon = True
+            flusher.start()
+            self._flusher_pid = os.getpid()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+
+user_writer = BatchedUserWriter()
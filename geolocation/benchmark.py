@@ -0,0 +1,148 @@
+# coding=utf-8
+"""
+Benchmark suite of GeoResolver running against the local Google Places stand-in.
+Every scenario resolves the same clustered request mix and reports requests/sec, p50/p99
+latency and upstream calls per request for a cache setting and a concurrency level.
+
+Without --redis the shared cache tier is replaced by an in-memory dict and the POI index is off.
+With --redis cached entries and indexed POIs outlive a scenario, so flush the database between runs.
+
+Usage: python -m togetherapi.geolocation.benchmark --requests 2000 --concurrency 1,8,32
+"""
+import argparse
+import random
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+from togetherapi.geolocation import client, core
+from togetherapi.geolocation.cache import GeoResultCache
+from togetherapi.geolocation.client import PlacesClient
+from togetherapi.geolocation.core import GeoRequest, GeoResolver
+from togetherapi.geolocation.standin import PlacesStandIn
+from togetherapi.helpers import percentile
+
+# city centers the simulated users cluster around
+HOTSPOTS = ((55.7558, 37.6173), (59.9343, 30.3351), (56.8389, 60.6057), (55.7887, 49.1221))
+LOOKUPS = (None, None, u'кафе', u'Тверская', u'pizza')
+RADII = (500, 1000, 1500, 5000)
+
+
+class DictRedis(object):
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+
+class NoCache(object):
+    def get(self, request):
+        return None
+
+    def set(self, request, results):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class Offline(object):
+    def is_online(self, phone):
+        return False
+
+
+class BenchUser(object):
+    UserPhone = 'bench'
+
+
+def build_requests(count, seed=42):
+    rng = random.Random(seed)
+    requests = []
+    for _ in range(count):
+        lat, lon = rng.choice(HOTSPOTS)
+        requests.append(GeoRequest(lat + rng.gauss(0, 0.003), lon + rng.gauss(0, 0.003), rng.choice(RADII),
+                                   rng.choice(LOOKUPS), rng.random() < 0.3))
+    return requests
+
+
+def check_poi_index():
+    """
+    Stores a complete search far from the hotspots and reads it back, an index that never answers
+    would otherwise only show up as upstream calls
+    """
+    request = GeoRequest(0.5, 0.5, 1000, None, False)
+    poi = {'place_id': 'benchmark-index-check', 'name': 'check', 'lat': 0.501, 'lng': 0.501}
+    core.poi_index.store(request, [poi], True)
+    found = core.poi_index.nearby(request)
+    if not found or found[0]['place_id'] != poi['place_id']:
+        raise SystemExit('POI index does not serve a stored area back: %s' % found)
+
+
+def run_scenario(standin, requests, concurrency):
+    def resolve(request):
+        started = time()
+        GeoResolver.lookup(request, BenchUser())
+        return time() - started
+
+    calls_before = sum(standin.stats().values())
+    started = time()
+    executor = ThreadPoolExecutor(concurrency)
+    latencies = list(executor.map(resolve, requests))
+    executor.shutdown()
+    elapsed = time() - started
+    calls = sum(standin.stats().values()) - calls_before
+    return {
+        'rps': len(requests) / elapsed,
+        'p50': percentile(latencies, 50) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+        'calls_per_request': float(calls) / len(requests)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='GeoResolver benchmark against the Google Places stand-in')
+    parser.add_argument('--port', type=int, default=8890)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument('--latency', type=float, default=0.08)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--quota-error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit', action='store_true', help='keep the per endpoint rate limits')
+    parser.add_argument('--redis', action='store_true', help='use a local Redis for the shared cache and POI index')
+    args = parser.parse_args()
+
+    standin = PlacesStandIn(args.port, args.latency, args.jitter, args.error_rate, args.quota_error_rate).start()
+    places = PlacesClient(base_url='http://localhost:%d' % args.port)
+    if not args.rate_limit:
+        places.buckets = {}
+    client.get_places_client.set(places)
+    core.presence = Offline()
+    if args.redis:
+        check_poi_index()
+    else:
+        core.POI_INDEX_ENABLED = False
+
+    requests = build_requests(args.requests)
+    print '%-8s %11s %10s %10s %10s %14s' % ('cache', 'concurrency', 'req/s', 'p50 ms', 'p99 ms', 'upstream/req')
+    for cache_name in ('off', 'on'):
+        for concurrency in [int(c) for c in args.concurrency.split(',')]:
+            if cache_name == 'on':
+                core.geo_cache = GeoResultCache(client=None if args.redis else DictRedis())
+            else:
+                core.geo_cache = NoCache()
+            result = run_scenario(standin, requests, concurrency)
+            print '%-8s %11d %10.1f %10.1f %10.1f %14.2f' % (cache_name, concurrency, result['rps'], result['p50'],
+                                                             result['p99'], result['calls_per_request'])
+            if cache_name == 'on':
+                print '         cache: %s' % core.geo_cache.stats()
+            if args.redis:
+                print '         index: %s' % core.poi_index.stats()
+    standin.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Microbenchmark of the Google response parsing on the payloads in geolocation/fixtures.
+Compares the previous path (stdlib json, full payload kept around) with the lean projection
+of PoiLookupResult/LocationSuggestionResult. Both parse the whole payload, the projection only
+drops the unused fields afterwards.
+
+Usage: python -m togetherapi.geolocation.benchmark_parser [--iterations 2000]
+"""
+import argparse
+import json
+import os
+import timeit
+
+from togetherapi.geolocation.core import PoiLookupResult, LocationSuggestionResult, fast_json
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, '%s.json' % name)) as fixture:
+        return fixture.read()
+
+
+def legacy_pois(payload):
+    raw = json.loads(payload)
+    results = []
+    for res in raw['results']:
+        results.append({
+            'type': 1,
+            'lat': res['geometry']['location']['lat'],
+            'lng': res['geometry']['location']['lng'],
+            'icon': res['icon'],
+            'name': res['name'],
+            'vicinity': res['vicinity'],
+            'id': res['id'],
+            'place_id': res['place_id'],
+            'ref': res['reference'],
+            'rating': res.get('rating')
+        })
+    return raw, results
+
+
+def legacy_suggestions(payload):
+    raw = json.loads(payload)
+    results = []
+    for res in raw['predictions']:
+        results.append({
+            'type': 2,
+            'vicinity': res['description'],
+            'id': res['id'],
+            'place_id': res['place_id'],
+            'ref': res['reference'],
+        })
+    return raw, results
+
+
+def lean_pois(payload):
+    return PoiLookupResult(payload).serialize()
+
+
+def lean_suggestions(payload):
+    return LocationSuggestionResult(payload).serialize()
+
+
+def measure(fn, payload, iterations):
+    seconds = min(timeit.repeat(lambda: fn(payload), number=iterations, repeat=3))
+    return seconds / iterations * 1000000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Google response parsing microbenchmark')
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    print 'JSON backend: %s' % fast_json.__name__
+    cases = (
+        ('nearbysearch', legacy_pois, lean_pois),
+        ('nearbysearch_page3', legacy_pois, lean_pois),
+        ('autocomplete', legacy_suggestions, lean_suggestions),
+    )
+    for name, legacy, lean in cases:
+        payload = load_fixture(name)
+        before = measure(legacy, payload, args.iterations)
+        after = measure(lean, payload, args.iterations)
+        print '%-20s %6d bytes  legacy %8.1f us  lean %8.1f us  x%.2f' % (name, len(payload), before, after,
+                                                                          before / after)
+
+
+if __name__ == '__main__':
+    main()
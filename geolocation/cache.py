@@ -0,0 +1,166 @@
+import json
+import math
+import threading
+
+import redis
+from concurrent.futures import Future
+
+from togetherapi import settings
+from togetherapi.helpers import TTLCache
+from togetherapi.utils import get_custom_logger
+
+logger = get_custom_logger()
+
+GEO_CACHE_TTL = getattr(settings, 'GEO_CACHE_TTL', 15 * 60)
+GEO_CACHE_LOCAL_SIZE = getattr(settings, 'GEO_CACHE_LOCAL_SIZE', 1000)
+GEO_CACHE_LOCAL_TTL = getattr(settings, 'GEO_CACHE_LOCAL_TTL', 60)
+# a geohash cell is at most radius / GEO_CELL_RATIO wide, so requests sharing it get nearly the same answer
+GEO_CELL_RATIO = getattr(settings, 'GEO_CELL_RATIO', 4)
+GEO_CACHE_KEY = 'geo:nearby:%s:%d:%s:%d'
+PLACE_DETAILS_CACHE_SIZE = getattr(settings, 'PLACE_DETAILS_CACHE_SIZE', 5000)
+PLACE_DETAILS_CACHE_TTL = getattr(settings, 'PLACE_DETAILS_CACHE_TTL', 60 * 60)
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+# approximate cell width in meters for geohash precisions 1..9
+_CELL_WIDTHS = (5009400, 1252300, 156500, 39100, 4900, 1200, 152.9, 38.2, 4.8)
+
+
+def geohash(lat, lon, precision):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        interval, coordinate = (lon_range, lon) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+
+def precision_for(radius):
+    for precision, width in enumerate(_CELL_WIDTHS, 1):
+        if width <= float(radius) / GEO_CELL_RATIO:
+            return precision
+    return len(_CELL_WIDTHS)
+
+
+def radius_bucket(radius):
+    return int(2 ** math.ceil(math.log(max(radius, 1), 2)))
+
+
+def normalize_lookup(lookup):
+    if lookup is None:
+        return ''
+    if not isinstance(lookup, unicode):
+        lookup = lookup.decode('utf-8')
+    return lookup.strip().lower().encode('utf-8')
+
+
+class GeoResultCache(object):
+    def __init__(self, client=None, ttl=GEO_CACHE_TTL):
+        """
+        Two tier cache of merged nearby search results: a small in-process LRU in front of
+        entries shared by every process through Redis
+        """
+        self.redis = client if client is not None else redis.Redis()
+        self.ttl = ttl
+        self.local = TTLCache(GEO_CACHE_LOCAL_SIZE, GEO_CACHE_LOCAL_TTL)
+        self.shared_hits = 0
+        self.misses = 0
+        self.google_calls_saved = 0
+
+    @staticmethod
+    def key(request):
+        return GEO_CACHE_KEY % (geohash(float(request.lat), float(request.lon), precision_for(request.radius)),
+                                radius_bucket(request.radius), normalize_lookup(request.lookup),
+                                1 if request.exact else 0)
+
+    def get(self, request):
+        key = self.key(request)
+        results = self.local.get(key)
+        if results is None:
+            try:
+                cached = self.redis.get(key)
+            except redis.RedisError, e:
+                logger.error('Geo cache is unavailable: %s' % e)
+                cached = None
+            if cached is None:
+                self.misses += 1
+                return None
+            results = json.loads(cached)
+            self.local.set(key, results)
+            self.shared_hits += 1
+        # a nearby search costs one call, one more for suggestions when something is looked up
+        self.google_calls_saved += 1 if request.lookup is None else 2
+        return results
+
+    def set(self, request, results):
+        # an empty result is as likely an unreported Google error as an empty area, it is not worth a TTL
+        if not results:
+            return
+        key = self.key(request)
+        self.local.set(key, results)
+        try:
+            self.redis.set(key, json.dumps(results), ex=self.ttl)
+        except redis.RedisError, e:
+            logger.error('Geo cache is unavailable: %s' % e)
+
+    def stats(self):
+        hits = self.local.hits + self.shared_hits
+        lookups = hits + self.misses
+        return {
+            'local_hits': self.local.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'hit_ratio': float(hits) / lookups if lookups else 0.0,
+            'google_calls_saved': self.google_calls_saved
+        }
+
+
+class SingleFlight(object):
+    def __init__(self):
+        """
+        Lets concurrent callers asking for the same key share a single computation
+        """
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+            future.set_result(result)
+            return result
+        except BaseException, e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+geo_cache = GeoResultCache()
+place_details = TTLCache(PLACE_DETAILS_CACHE_SIZE, PLACE_DETAILS_CACHE_TTL)
+place_details_flight = SingleFlight()
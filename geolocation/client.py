@@ -0,0 +1,97 @@
+import threading
+from time import time, sleep
+
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+from togetherapi import settings
+from togetherapi.helpers import per_process
+from togetherapi.utils import get_custom_logger
+
+GOOGLE_PLACES_URL = getattr(settings, 'GOOGLE_PLACES_URL', 'https://maps.googleapis.com/maps/api/place')
+GEO_HTTP_TIMEOUT = getattr(settings, 'GEO_HTTP_TIMEOUT', 5)
+GEO_HTTP_RETRIES = getattr(settings, 'GEO_HTTP_RETRIES', 2)
+GEO_HTTP_POOL_SIZE = getattr(settings, 'GEO_HTTP_POOL_SIZE', 20)
+# requests per second allowed to every process, the sum over all processes has to stay within the Google quota
+GEO_RATE_LIMITS = getattr(settings, 'GEO_RATE_LIMITS', {'nearbysearch': 10, 'autocomplete': 10, 'details': 10})
+GEO_RATE_LIMIT_WAIT = getattr(settings, 'GEO_RATE_LIMIT_WAIT', 5)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: tokens added per second
+        :param burst: bucket capacity, defaults to one second worth of tokens
+        """
+        self.rate = float(rate)
+        self.capacity = float(burst if burst is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.throttled = 0
+        self._updated = time()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout=None):
+        deadline = time() + timeout if timeout is not None else None
+        while True:
+            with self._lock:
+                now = time()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if deadline is not None and now + wait > deadline:
+                self.throttled += 1
+                return False
+            sleep(wait)
+
+
+class PlacesClient(object):
+    def __init__(self, base_url=GOOGLE_PLACES_URL, timeout=GEO_HTTP_TIMEOUT, retries=GEO_HTTP_RETRIES,
+                 pool_size=GEO_HTTP_POOL_SIZE):
+        """
+        Google Places HTTP client keeping its connections alive between requests
+        :param timeout: seconds allowed to connect and to wait for each response
+        :param retries: how many times a failed connection or a 5xx response is retried
+        :param pool_size: number of kept-alive connections and of concurrent requests
+        """
+        self.base_url = base_url
+        self.timeout = timeout
+        self.logger = get_custom_logger()
+        self.calls = 0
+        self.buckets = dict((endpoint, TokenBucket(rate)) for endpoint, rate in GEO_RATE_LIMITS.items())
+        retry = Retry(total=retries, backoff_factor=0.1, status_forcelist=(500, 502, 503, 504))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(pool_size)
+
+    def get(self, endpoint, params):
+        """
+        Calls a Places endpoint such as nearbysearch, autocomplete or details
+        :return: raw JSON response body
+        """
+        bucket = self.buckets.get(endpoint)
+        if bucket is not None and not bucket.acquire(GEO_RATE_LIMIT_WAIT):
+            raise QuotaExceeded('Rate limit of %s exceeded' % endpoint)
+        self.calls += 1
+        response = self.session.get('%s/%s/json' % (self.base_url, endpoint), params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def fetch(self, endpoint, params):
+        """
+        Same as get, but runs concurrently and returns a future
+        """
+        return self.executor.submit(self.get, endpoint, params)
+
+
+get_places_client = per_process(PlacesClient)
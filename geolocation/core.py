@@ -1,14 +1,36 @@
 import json
-import urllib2
+import threading
+import uuid
 
-import tornadoredis
+from concurrent.futures import as_completed
 
+from togetherapi import settings
+from togetherapi.geolocation.cache import geo_cache, place_details, place_details_flight
+from togetherapi.geolocation.client import get_places_client
+from togetherapi.geolocation.index import POI_INDEX_ENABLED, poi_index
 from togetherapi.settings import MAX_GEO_RESPONSES
+from togetherapi.sockets import replay
+from togetherapi.sockets.presence import presence
+from togetherapi.sockets.publisher import get_publisher
 from togetherapi.utils import get_custom_logger, get_google_key
 
+try:
+    import ujson as fast_json
+except ImportError:
+    fast_json = json
+
 logger = get_custom_logger()
 radius_threshold = 50000
 
+# publish POIs and suggestions as separate chunks as soon as each of them arrives
+GEO_PROGRESSIVE = getattr(settings, 'GEO_PROGRESSIVE', False)
+# Google serves at most three pages of nearby search results
+GEO_MAX_PAGES = getattr(settings, 'GEO_MAX_PAGES', 3)
+GEO_PAGE_TOKEN_DELAY = getattr(settings, 'GEO_PAGE_TOKEN_DELAY', 2)
+GEO_PAGE_ATTEMPTS = getattr(settings, 'GEO_PAGE_ATTEMPTS', 3)
+# queue lookups on the bounded geo_scheduler instead of resolving them on the calling thread
+GEO_SCHEDULER_ENABLED = getattr(settings, 'GEO_SCHEDULER_ENABLED', True)
+
 
 # noinspection PyBroadException
 class GeoRequest(object):
@@ -33,65 +55,203 @@ class GeoRequest(object):
 class GeoResolver(object):
     @staticmethod
     def requestGoogleServices(request, user=None):
+        """
+        Resolves a request whose results are published to the user channel
+        :return: False when the lookup failed or the scheduler queue is full
+        """
+        if GEO_SCHEDULER_ENABLED:
+            # the scheduler module imports this one
+            from togetherapi.geolocation.scheduler import geo_scheduler
+            return geo_scheduler.submit(request, user)
+        return GeoResolver.lookup(request, user)
+
+    @staticmethod
+    def lookup(request, user=None):
+        """
+        Resolves a request on the calling thread, the scheduler workers run it
+        """
         try:
-            lat_long = "%s,%s" % (request.lat, request.lon)
-            # looking up for location's POI
+            if GEO_PROGRESSIVE:
+                return GeoResolver._stream(request, user)
+            j_response = geo_cache.get(request)
+            if j_response is None:
+                j_response = GeoResolver._resolve(request)
+                geo_cache.set(request, j_response)
+            # async feedback, in replay mode offline users catch up when they reconnect
+            if replay.REPLAY_ENABLED or presence.is_online(user.UserPhone):
+                logger.debug('Sending async data: %s', j_response)
+                get_publisher().publish(user.UserPhone, json.dumps(j_response))
+            return True
+        except BaseException, ex:
+            logger.error(ex.message)
+            return False
+
+    @staticmethod
+    def _start_fetches(request):
+        """
+        :return: (pois, nearby, suggested) where pois are the POIs found in the local index, or None
+        if Google is asked instead, nearby and suggested are futures of the raw Google responses
+        """
+        lat_long = "%s,%s" % (request.lat, request.lon)
+        places = get_places_client()
+        # looking up for location's POI, Google is only asked when the local index does not cover the area
+        pois = GeoResolver._indexed_pois(request)
+        nearby = None
+        if pois is None:
+            params = {'location': lat_long, 'radius': request.radius, 'key': request.key}
             if request.lookup is not None:
-                requested_url = \
-                    'https://maps.googleapis.com/maps/api/place/nearbysearch/json?location=%s&radius=%d&name=%s&key=%s' % (
-                        lat_long, request.radius, request.lookup, request.key)
-            else:
-                requested_url = \
-                    'https://maps.googleapis.com/maps/api/place/nearbysearch/json?location=%s&radius=%d&key=%s' % (
-                        lat_long, request.radius, request.key)
-            fetched = urllib2.urlopen(requested_url.encode('utf-8')).read()
-            poi_response = PoiLookupResult(fetched)
-
-            # looking up for locations suggestions
-            requested_url = \
-                'https://maps.googleapis.com/maps/api/place/autocomplete/json?input={0}&types=geocode&location={1}&language=ru&key={2}'.format(
-                    request.lookup, lat_long, request.key)
-            fetched2 = urllib2.urlopen(requested_url.encode('utf-8')).read()
-            suggestion_response = LocationSuggestionResult(fetched2)
+                params['name'] = request.lookup
+            nearby = places.fetch('nearbysearch', params)
 
+        # looking up for locations suggestions, both requests run concurrently
+        suggested = None
+        if request.lookup is not None:
+            suggested = places.fetch('autocomplete', {
+                'input': request.lookup,
+                'types': 'geocode',
+                'location': lat_long,
+                'language': 'ru',
+                'key': request.key
+            })
+        return pois, nearby, suggested
+
+    @staticmethod
+    def _resolve(request):
+        pois, nearby, suggested = GeoResolver._start_fetches(request)
+        if nearby is not None:
+            poi_response = PoiLookupResult(nearby.result())
             pois = poi_response.serialize()
-            suggestions = suggestion_response.serialize()
-            j_response = []
-            plen = len(pois)
-            slen = len(suggestions)
-            if plen > 100 and slen > 100:
-                mx = plen if plen - slen > 0 else slen
-            else:
-                mx = 100
-            if request.exact:
-                selection_limit = MAX_GEO_RESPONSES
-            else:
-                selection_limit = mx
-            for i in range(selection_limit):
-                mod = i % 2
-                if mod == 0 or i == 0:
-                    if plen > i:
-                        j_response.append(pois[i])
-                    elif slen > i:
-                        j_response.append(suggestions[i])
-                    else:
-                        break
-                else:
-                    if slen > i:
-                        j_response.append(suggestions[i])
-                    elif plen > i:
-                        j_response.append(pois[i])
-                    else:
-                        break
-            # async feedback
-            with tornadoredis.Client() as redis:
-                if user.UserConnected:
-                    logger.debug('Sending async data: {0}'.format(j_response))
-                    redis.publish(user.UserPhone, json.dumps(j_response))
+            GeoResolver._index_pois(request, pois, poi_response.next_page_token is None)
+        suggestions = LocationSuggestionResult(suggested.result()).serialize() if suggested is not None else []
+        return GeoResolver._merge(pois, suggestions, request.exact)
+
+    @staticmethod
+    def _stream(request, user):
+        """
+        Progressive mode: POIs and suggestions are published as separate chunks as soon as each
+        Google response arrives, further nearby search pages follow as additional chunks
+        """
+        if not (replay.REPLAY_ENABLED or presence.is_online(user.UserPhone)):
             return True
+        stream = GeoStream(user.UserPhone, MAX_GEO_RESPONSES if request.exact else None)
+        cached = geo_cache.get(request)
+        if cached is not None:
+            stream.send('merged', cached, True)
+            return True
+        pois, nearby, suggested = GeoResolver._start_fetches(request)
+        pending = dict((future, kind) for future, kind in ((nearby, 'poi'), (suggested, 'suggestion'))
+                       if future is not None)
+        if pois is not None:
+            stream.send('poi', pois, not pending)
+        suggestions = []
+        next_page = None
+        remaining = len(pending)
+        failed = False
+        for future in as_completed(pending):
+            kind = pending[future]
+            remaining -= 1
+            try:
+                if kind == 'poi':
+                    poi_response = PoiLookupResult(future.result())
+                    pois = poi_response.serialize()
+                    next_page = poi_response.next_page_token
+                    GeoResolver._index_pois(request, pois, next_page is None)
+                    if request.exact:
+                        next_page = None
+                    items = pois
+                else:
+                    items = suggestions = LocationSuggestionResult(future.result()).serialize()
+            except BaseException, ex:
+                logger.error('Progressive %s lookup failed: %s' % (kind, ex))
+                failed = True
+                items = []
+            stream.send(kind, items, remaining == 0 and next_page is None)
+        # a partial result would be served to the whole geohash cell for a TTL
+        if not failed:
+            geo_cache.set(request, GeoResolver._merge(pois or [], suggestions, request.exact))
+        if next_page is not None:
+            GeoResolver._follow_page(request, stream, next_page, 2)
+        return True
+
+    @staticmethod
+    def _follow_page(request, stream, token, page, attempt=1):
+        # Google needs a moment before a next_page_token becomes valid
+        timer = threading.Timer(GEO_PAGE_TOKEN_DELAY, GeoResolver._fetch_page, (request, stream, token, page, attempt))
+        timer.daemon = True
+        timer.start()
+
+    @staticmethod
+    def _fetch_page(request, stream, token, page, attempt):
+        try:
+            try:
+                poi_response = PoiLookupResult(get_places_client().get('nearbysearch', {
+                    'pagetoken': token,
+                    'key': request.key
+                }))
+            except GoogleServiceError, ex:
+                if ex.status == 'INVALID_REQUEST' and attempt < GEO_PAGE_ATTEMPTS:
+                    GeoResolver._follow_page(request, stream, token, page, attempt + 1)
+                    return
+                raise
+            pois = poi_response.serialize()
+            GeoResolver._index_pois(request, pois, False)
+            next_page = poi_response.next_page_token if page < GEO_MAX_PAGES else None
+            stream.send('poi', pois, next_page is None)
+            if next_page is not None:
+                GeoResolver._follow_page(request, stream, next_page, page + 1)
         except BaseException, ex:
-            logger.error(ex.message)
-            return False
+            logger.error('Unable to fetch page %d of nearby search: %s' % (page, ex))
+            stream.send('poi', [], True)
+
+    @staticmethod
+    def _indexed_pois(request):
+        if not POI_INDEX_ENABLED:
+            return None
+        try:
+            return poi_index.nearby(request)
+        except BaseException, ex:
+            logger.error('POI index lookup failed: %s' % ex)
+            return None
+
+    @staticmethod
+    def _index_pois(request, pois, complete):
+        if not POI_INDEX_ENABLED:
+            return
+        try:
+            poi_index.store(request, pois, complete)
+        except BaseException, ex:
+            logger.error('Unable to index POIs: %s' % ex)
+
+    @staticmethod
+    def _merge(pois, suggestions, exact):
+        j_response = []
+        plen = len(pois)
+        slen = len(suggestions)
+        if plen > 100 and slen > 100:
+            mx = plen if plen - slen > 0 else slen
+        else:
+            mx = 100
+        if exact:
+            selection_limit = MAX_GEO_RESPONSES
+        else:
+            selection_limit = mx
+        for i in range(selection_limit):
+            mod = i % 2
+            if mod == 0 or i == 0:
+                if plen > i:
+                    j_response.append(pois[i])
+                elif slen > i:
+                    j_response.append(suggestions[i])
+                else:
+                    break
+            else:
+                if slen > i:
+                    j_response.append(suggestions[i])
+                elif plen > i:
+                    j_response.append(pois[i])
+                else:
+                    break
+        return j_response
 
     @staticmethod
     def requestObjectDetails(object_id):
@@ -99,26 +259,79 @@ class GeoResolver(object):
             if object_id is None:
                 raise Exception('Bad or empty object_id')
             else:
-                requested_url = 'https://maps.googleapis.com/maps/api/place/details/json?placeid=%s&key=%s' % (
-                    object_id, get_google_key())
-                return urllib2.urlopen(requested_url.encode('utf-8')).read()
+                details = place_details.get(object_id)
+                if details is None:
+                    details = place_details_flight.do(object_id, lambda: GeoResolver._fetch_details(object_id))
+                return details
         except BaseException:
             return None
 
+    @staticmethod
+    def _fetch_details(object_id):
+        # a caller could have missed the cache right before the previous flight filled it
+        details = place_details.get(object_id)
+        if details is None:
+            details = get_places_client().get('details', {'placeid': object_id, 'key': get_google_key()})
+            # quota and request errors must not stick for a whole TTL
+            if json.loads(details).get('status') in ('OK', 'ZERO_RESULTS', 'NOT_FOUND'):
+                place_details.set(object_id, details)
+        return details
+
+
+class GeoStream(object):
+    def __init__(self, channel, limit=None):
+        """
+        Sequence of result chunks of one request published to the user channel. Every chunk is
+        {"rid": <request id>, "seq": <0 based position>, "kind": "poi" | "suggestion" | "merged",
+        "items": [...], "last": <whether no more chunks follow>}
+        """
+        self.channel = channel
+        self.limit = limit
+        self.rid = uuid.uuid4().hex
+        self.seq = 0
+        self._lock = threading.Lock()
+
+    def send(self, kind, items, last):
+        with self._lock:
+            chunk = {
+                'rid': self.rid,
+                'seq': self.seq,
+                'kind': kind,
+                'items': items[:self.limit] if self.limit is not None else items,
+                'last': last
+            }
+            self.seq += 1
+            get_publisher().publish(self.channel, json.dumps(chunk))
+
+
+class GoogleServiceError(Exception):
+    def __init__(self, status, message=None):
+        super(GoogleServiceError, self).__init__('Google services responded with %s: %s' % (status, message))
+        self.status = status
+
 
 class GeoResult(object):
     logger = get_custom_logger()
-    json_raw_results = None
+    next_page_token = None
+    results = None
 
     def serialize(self):
-        pass
+        return list(self.results)
+
+    def _project(self, j_response):
+        return []
 
     def __init__(self, http_response):
-        j_response = json.loads(http_response)
-        if j_response is not None:
-            self.json_raw_results = j_response
-        else:
+        j_response = fast_json.loads(http_response)
+        if j_response is None:
             raise BaseException('Unable to serialize HTTP-result from Google services')
+        # quota and request errors must neither pass for empty results nor end up cached
+        status = j_response.get('status')
+        if status not in (None, 'OK', 'ZERO_RESULTS'):
+            raise GoogleServiceError(status, j_response.get('error_message'))
+        self.next_page_token = j_response.get('next_page_token')
+        # the whole payload is parsed, the fields we do not emit (photos, opening hours...) are dropped right after
+        self.results = self._project(j_response)
 
 
 # noinspection PyBroadException
@@ -126,14 +339,15 @@ class PoiLookupResult(GeoResult):
     def __init__(self, http_response):
         super(PoiLookupResult, self).__init__(http_response)
 
-    def serialize(self):
+    def _project(self, j_response):
         results = []
         try:
-            for res in self.json_raw_results['results']:
+            for res in j_response['results']:
+                location = res['geometry']['location']
                 results.append({
                     'type': 1,
-                    'lat': res['geometry']['location']['lat'],
-                    'lng': res['geometry']['location']['lng'],
+                    'lat': location['lat'],
+                    'lng': location['lng'],
                     'icon': res['icon'],
                     'name': res['name'],
                     'vicinity': res['vicinity'],
@@ -145,7 +359,7 @@ class PoiLookupResult(GeoResult):
         except BaseException, ex:
             self.logger.error(ex.message)
         finally:
-            self.logger.debug(results)
+            self.logger.debug('%s', results)
             return results
 
 
@@ -154,10 +368,10 @@ class LocationSuggestionResult(GeoResult):
     def __init__(self, http_response):
         super(LocationSuggestionResult, self).__init__(http_response)
 
-    def serialize(self):
+    def _project(self, j_response):
         results = []
         try:
-            for res in self.json_raw_results['predictions']:
+            for res in j_response['predictions']:
                 results.append({
                     'type': 2,
                     'vicinity': res['description'],
@@ -168,5 +382,5 @@ class LocationSuggestionResult(GeoResult):
         except BaseException, ex:
             self.logger.error(ex.message)
         finally:
-            self.logger.debug(results)
+            self.logger.debug('%s', results)
             return results
@@ -0,0 +1,132 @@
+import json
+from time import time
+
+import redis
+
+from togetherapi import settings
+from togetherapi.geolocation.cache import normalize_lookup
+from togetherapi.utils import get_custom_logger
+
+logger = get_custom_logger()
+
+# answer covered nearby searches from POIs stored by earlier searches instead of asking Google
+POI_INDEX_ENABLED = getattr(settings, 'POI_INDEX_ENABLED', True)
+POI_INDEX_FRESHNESS = getattr(settings, 'POI_INDEX_FRESHNESS', 6 * 60 * 60)
+POI_INDEX_PRUNE_EVERY = getattr(settings, 'POI_INDEX_PRUNE_EVERY', 100)
+# coverage circles are looked up around the requested point up to the largest radius Google allows
+POI_COVERAGE_SEARCH_RADIUS = 50000
+# GEO sets store coordinates as 52 bit geohashes, a repeated search lands up to 0.6m away from its own circle
+POI_COVERAGE_TOLERANCE = 1
+
+POI_GEO_KEY = 'poi:geo'
+POI_DATA_KEY = 'poi:data'
+POI_SEEN_KEY = 'poi:seen'
+POI_COVERAGE_KEY = 'poi:coverage:%s'
+POI_COVERAGE_SEEN_KEY = 'poi:coverage:seen'
+
+
+class PoiIndex(object):
+    def __init__(self, client=None, freshness=POI_INDEX_FRESHNESS):
+        """
+        Spatial index of the POIs returned by nearby searches, kept in Redis GEO sets.
+        Besides the POIs it records coverage circles: areas for which a nearby search returned
+        its complete result, i.e. without a next page. A search inside a fresh coverage circle
+        of the same lookup, or of an unfiltered search, can be answered from the index.
+        """
+        self.redis = client if client is not None else redis.Redis()
+        self.freshness = freshness
+        self.hits = 0
+        self.misses = 0
+        self._stores = 0
+
+    @staticmethod
+    def _coverage_key(lookup):
+        return POI_COVERAGE_KEY % normalize_lookup(lookup)
+
+    def covered(self, request):
+        oldest = time() - self.freshness
+        pipe = self.redis.pipeline(transaction=False)
+        keys = [self._coverage_key(request.lookup)]
+        if request.lookup is not None:
+            # unfiltered results can be filtered by name locally
+            keys.append(self._coverage_key(None))
+        for key in keys:
+            pipe.georadius(key, request.lon, request.lat, POI_COVERAGE_SEARCH_RADIUS, unit='m', withdist=True)
+        for circles in pipe.execute():
+            for member, distance in circles:
+                radius, seen = member.split(':')[1:]
+                if float(seen) >= oldest and float(distance) + request.radius <= float(radius) + POI_COVERAGE_TOLERANCE:
+                    return True
+        return False
+
+    def nearby(self, request):
+        """
+        :return: POIs inside the requested circle ordered by distance, or None when the area is not covered
+        """
+        if not self.covered(request):
+            self.misses += 1
+            return None
+        found = self.redis.georadius(POI_GEO_KEY, request.lon, request.lat, request.radius, unit='m', sort='ASC')
+        oldest = time() - self.freshness
+        terms = normalize_lookup(request.lookup).split()
+        results = []
+        for data in self.redis.hmget(POI_DATA_KEY, found) if found else []:
+            if data is None:
+                continue
+            poi = json.loads(data)
+            if poi.pop('seen') < oldest:
+                continue
+            name = normalize_lookup(poi['name'])
+            if all(term in name for term in terms):
+                results.append(poi)
+        self.hits += 1
+        return results
+
+    def store(self, request, pois, complete):
+        """
+        Adds the POIs of a nearby search
+        :param complete: whether Google returned every result, only then the searched circle counts as covered.
+        A circle without POIs is never recorded, it would answer every search inside it with nothing.
+        """
+        now = time()
+        pipe = self.redis.pipeline(transaction=False)
+        for poi in pois:
+            pipe.execute_command('GEOADD', POI_GEO_KEY, poi['lng'], poi['lat'], poi['place_id'])
+            pipe.hset(POI_DATA_KEY, poi['place_id'], json.dumps(dict(poi, seen=now)))
+            pipe.execute_command('ZADD', POI_SEEN_KEY, now, poi['place_id'])
+        if complete and pois:
+            key = self._coverage_key(request.lookup)
+            member = '%s,%s:%d:%d' % (request.lat, request.lon, request.radius, now)
+            pipe.execute_command('GEOADD', key, request.lon, request.lat, member)
+            pipe.execute_command('ZADD', POI_COVERAGE_SEEN_KEY, now, '%s|%s' % (key, member))
+        pipe.execute()
+        self._stores += 1
+        if self._stores % POI_INDEX_PRUNE_EVERY == 0:
+            self.prune()
+
+    def prune(self):
+        oldest = time() - self.freshness
+        stale = self.redis.zrangebyscore(POI_SEEN_KEY, '-inf', oldest)
+        stale_coverage = self.redis.zrangebyscore(POI_COVERAGE_SEEN_KEY, '-inf', oldest)
+        pipe = self.redis.pipeline(transaction=False)
+        if stale:
+            pipe.zrem(POI_GEO_KEY, *stale)
+            pipe.hdel(POI_DATA_KEY, *stale)
+            pipe.zrem(POI_SEEN_KEY, *stale)
+        for entry in stale_coverage:
+            key, member = entry.rsplit('|', 1)
+            pipe.zrem(key, member)
+        if stale_coverage:
+            pipe.zrem(POI_COVERAGE_SEEN_KEY, *stale_coverage)
+        pipe.execute()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0
+        }
+
+
+poi_index = PoiIndex()
@@ -0,0 +1,111 @@
+import itertools
+import os
+import threading
+from Queue import PriorityQueue, Full
+from collections import deque
+from time import time
+
+from togetherapi import settings
+from togetherapi.geolocation.cache import GeoResultCache
+from togetherapi.geolocation.core import GeoResolver
+from togetherapi.helpers import percentile
+from togetherapi.utils import get_custom_logger
+
+GEO_WORKERS = getattr(settings, 'GEO_WORKERS', 8)
+GEO_QUEUE_SIZE = getattr(settings, 'GEO_QUEUE_SIZE', 1000)
+
+PRIORITY_EXACT = 0
+PRIORITY_BROWSE = 1
+
+
+class GeoJob(object):
+    def __init__(self, key, request, user):
+        self.key = key
+        self.request = request
+        self.user = user
+        self.queued = time()
+
+
+class GeoJobScheduler(object):
+    def __init__(self, workers=GEO_WORKERS, max_queued=GEO_QUEUE_SIZE):
+        """
+        Bounded queue of geo lookups served by a pool of worker threads. Exact lookups are served
+        before browsing ones and a job identical to a queued one of the same user is coalesced into it.
+        Google calls of the workers are throttled by the per endpoint rate limits of the Places client.
+        """
+        self.workers = workers
+        self.queue = PriorityQueue(max_queued)
+        self.logger = get_custom_logger()
+        self.submitted = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_times = deque(maxlen=10000)
+        self._queued = {}
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+        self._workers_pid = None
+
+    def submit(self, request, user):
+        """
+        Queues a lookup whose results are published to the user channel
+        :return: False when the queue is full
+        """
+        self._ensure_workers()
+        key = (user.UserPhone, GeoResultCache.key(request))
+        priority = PRIORITY_EXACT if request.exact else PRIORITY_BROWSE
+        with self._lock:
+            self.submitted += 1
+            if key in self._queued:
+                self.coalesced += 1
+                return True
+            job = GeoJob(key, request, user)
+            try:
+                self.queue.put_nowait((priority, next(self._order), job))
+            except Full:
+                self.rejected += 1
+                self.logger.error('Geo job queue is full, lookup of %s rejected' % user.UserPhone)
+                return False
+            self._queued[key] = job
+        return True
+
+    def stats(self):
+        waits = list(self.wait_times)
+        return {
+            'depth': self.queue.qsize(),
+            'submitted': self.submitted,
+            'coalesced': self.coalesced,
+            'rejected': self.rejected,
+            'completed': self.completed,
+            'failed': self.failed,
+            'wait_p50': percentile(waits, 50),
+            'wait_p99': percentile(waits, 99)
+        }
+
+    def _ensure_workers(self):
+        if self._workers_pid == os.getpid():
+            return
+        with self._lock:
+            if self._workers_pid == os.getpid():
+                return
+            for index in range(self.workers):
+                worker = threading.Thread(target=self._work, name='geo-worker-%d' % index)
+                worker.daemon = True
+                worker.start()
+            self._workers_pid = os.getpid()
+
+    def _work(self):
+        while True:
+            priority, order, job = self.queue.get()
+            # requests arriving from now on need a new lookup
+            with self._lock:
+                self._queued.pop(job.key, None)
+            self.wait_times.append(time() - job.queued)
+            if GeoResolver.lookup(job.request, job.user):
+                self.completed += 1
+            else:
+                self.failed += 1
+
+
+geo_scheduler = GeoJobScheduler()
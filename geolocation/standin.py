@@ -0,0 +1,118 @@
+"""
+Local stand-in for the Google Places API serving the recorded responses in geolocation/fixtures.
+Point GeoResolver at it with GOOGLE_PLACES_URL = 'http://localhost:<port>'.
+
+Usage: python -m togetherapi.geolocation.standin --port 8890 --latency 0.08 --error-rate 0.01
+"""
+import argparse
+import json
+import os
+import random
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from collections import defaultdict
+from time import sleep
+from urlparse import urlparse, parse_qs
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+PAGES = ('nearbysearch', 'nearbysearch_page2', 'nearbysearch_page3')
+QUOTA_ERROR = json.dumps({'error_message': 'You have exceeded your daily request quota for this API.',
+                          'results': [], 'status': 'OVER_QUERY_LIMIT'})
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, '%s.json' % name)) as fixture:
+        return fixture.read()
+
+
+class PlacesStandIn(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, latency=0.0, jitter=0.0, error_rate=0.0, quota_error_rate=0.0):
+        """
+        :param latency: seconds every response is delayed by
+        :param jitter: maximum random extra delay in seconds
+        :param error_rate: share of requests answered with HTTP 500
+        :param quota_error_rate: share of requests answered with an OVER_QUERY_LIMIT status
+        """
+        HTTPServer.__init__(self, ('localhost', port), PlacesRequestHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.quota_error_rate = quota_error_rate
+        self.fixtures = dict((name, load_fixture(name)) for name in PAGES + ('autocomplete', 'details'))
+        # every page links to the next one through its next_page_token
+        self.pages = {}
+        for name, next_name in zip(PAGES, PAGES[1:]):
+            self.pages[json.loads(self.fixtures[name])['next_page_token']] = next_name
+        self.calls = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def count(self, endpoint):
+        with self.lock:
+            self.calls[endpoint] += 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def start(self):
+        server = threading.Thread(target=self.serve_forever, name='places-stand-in')
+        server.daemon = True
+        server.start()
+        return self
+
+
+class PlacesRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _respond(self, code, body):
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            return self._respond(200, json.dumps(server.stats()))
+        endpoint = url.path.strip('/').split('/')[0]
+        if endpoint not in ('nearbysearch', 'autocomplete', 'details'):
+            return self._respond(404, json.dumps({'status': 'NOT_FOUND'}))
+        server.count(endpoint)
+        sleep(server.latency + random.uniform(0, server.jitter))
+        roll = random.random()
+        if roll < server.error_rate:
+            return self._respond(500, json.dumps({'status': 'UNKNOWN_ERROR'}))
+        if roll < server.error_rate + server.quota_error_rate:
+            return self._respond(200, QUOTA_ERROR)
+        if endpoint == 'nearbysearch':
+            token = parse_qs(url.query).get('pagetoken', [None])[0]
+            if token is None:
+                return self._respond(200, server.fixtures['nearbysearch'])
+            if token not in server.pages:
+                return self._respond(200, json.dumps({'results': [], 'status': 'INVALID_REQUEST'}))
+            return self._respond(200, server.fixtures[server.pages[token]])
+        return self._respond(200, server.fixtures[endpoint])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Google Places API stand-in')
+    parser.add_argument('--port', type=int, default=8890)
+    parser.add_argument('--latency', type=float, default=0.08)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--quota-error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    print 'Serving Google Places stand-in on http://localhost:%d' % args.port
+    PlacesStandIn(args.port, args.latency, args.jitter, args.error_rate, args.quota_error_rate).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Building blocks shared by the auth, sockets, geolocation and notifications packages
+"""
+import os
+import threading
+from collections import OrderedDict
+from time import time
+
+__author__ = 'arclite'
+
+
+class TTLCache(object):
+    def __init__(self, max_size, ttl):
+        """
+        In-process LRU cache with a per-entry expiration time
+        :param max_size: maximum number of entries kept, least recently used entries are evicted first
+        :param ttl: default entry lifetime in seconds
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < time():
+                self.misses += 1
+                return default
+            # re-inserting moves the entry to the most recently used end
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        expires = time() + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            return self._entries.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class per_process(object):
+    def __init__(self, factory):
+        """
+        Accessor of an instance created lazily once per process. Socket and APNS workers are forked,
+        so connections, executors and threads of the parent must never be used after a fork.
+        :param factory: callable creating the instance
+        """
+        self.factory = factory
+        self.instance = None
+        self.pid = None
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        if self.instance is None or self.pid != os.getpid():
+            with self._lock:
+                # another thread may have created it while this one was waiting
+                if self.instance is None or self.pid != os.getpid():
+                    self.instance = self.factory()
+                    self.pid = os.getpid()
+        return self.instance
+
+    def set(self, instance):
+        """
+        Installs the instance of the current process, benchmarks swap in their stand-ins this way
+        """
+        with self._lock:
+            self.instance = instance
+            self.pid = os.getpid()
+
+
+def percentile(samples, p):
+    """
+    Nearest-rank percentile
+    :param samples: unordered samples
+    :param p: percentile between 0 and 100
+    :return: None without samples
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
@@ -0,0 +1,138 @@
+import json
+
+import redis
+from mongoengine import signals
+
+from Api.models import User
+from togetherapi import settings
+from togetherapi.utils import get_custom_logger
+
+__author__ = 'arclite'
+
+DEVICE_TOKENS_KEY = getattr(settings, 'DEVICE_TOKENS_KEY', 'devices:%s')
+# bounds how long a device change made by a queryset update, which sends no signal, goes unnoticed
+DEVICE_TOKENS_TTL = getattr(settings, 'DEVICE_TOKENS_TTL', 10 * 60)
+
+
+def normalize_token(token):
+    """
+    Strips the spaces and brackets of a token copied from the NSData description
+    :return: lowercase hex token or None if nothing is left
+    """
+    if not token:
+        return None
+    token = token.replace(' ', '').strip('<>').lower()
+    return token or None
+
+
+def device_tokens_of(user):
+    tokens = []
+    for device in user.UserDevices or []:
+        token = normalize_token(device.DeviceCMToken)
+        if token is not None and token not in tokens:
+            tokens.append(token)
+    return tokens
+
+
+class DeviceTokenCache(object):
+    def __init__(self, client=None, ttl=DEVICE_TOKENS_TTL):
+        """
+        Normalized APNS device tokens of every user keyed by phone, so delivering a notification
+        does not need the User document. Misses are loaded with one query projected to the devices.
+        :param client: redis client, a new one is created if omitted
+        :param ttl: seconds the tokens of a user are kept
+        """
+        self.redis = client if client is not None else redis.Redis()
+        self.ttl = ttl
+        self.logger = get_custom_logger()
+        self.hits = 0
+        self.misses = 0
+        self.queries = 0
+
+    def get_many(self, phones):
+        """
+        :return: dict mapping the phone of every existing user to its device tokens
+        """
+        phones = list(set(phones))
+        try:
+            cached = self.redis.mget([DEVICE_TOKENS_KEY % phone for phone in phones])
+        except redis.RedisError, e:
+            self.logger.error('Unable to read device tokens: %s' % e)
+            cached = [None] * len(phones)
+        tokens = {}
+        missing = []
+        for phone, value in zip(phones, cached):
+            if value is not None:
+                tokens[phone] = json.loads(value)
+            else:
+                missing.append(phone)
+        self.hits += len(tokens)
+        self.misses += len(missing)
+        if missing:
+            tokens.update(self._load(missing))
+        return tokens
+
+    def get(self, phone):
+        return self.get_many([phone]).get(phone)
+
+    def _load(self, phones):
+        self.queries += 1
+        loaded = {}
+        pipe = self.redis.pipeline(transaction=False)
+        for user in User.objects(UserPhone__in=phones).only('UserPhone', 'UserDevices'):
+            loaded[user.UserPhone] = device_tokens_of(user)
+            # users without devices are not cached, their first device must get pushes right away
+            if loaded[user.UserPhone]:
+                pipe.set(DEVICE_TOKENS_KEY % user.UserPhone, json.dumps(loaded[user.UserPhone]), ex=self.ttl)
+        if len(pipe):
+            try:
+                pipe.execute()
+            except redis.RedisError, e:
+                self.logger.error('Unable to cache device tokens: %s' % e)
+        return loaded
+
+    def refresh(self, user):
+        """
+        Stores the current devices of a user, call it whenever UserDevices changes
+        """
+        tokens = device_tokens_of(user)
+        if not tokens:
+            return self.invalidate(user.UserPhone)
+        try:
+            self.redis.set(DEVICE_TOKENS_KEY % user.UserPhone, json.dumps(tokens), ex=self.ttl)
+        except redis.RedisError, e:
+            self.logger.error('Unable to refresh device tokens of %s: %s' % (user.UserPhone, e))
+
+    def invalidate(self, phone):
+        try:
+            self.redis.delete(DEVICE_TOKENS_KEY % phone)
+        except redis.RedisError, e:
+            self.logger.error('Unable to invalidate device tokens of %s: %s' % (phone, e))
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'queries': self.queries,
+            # every hit used to be a full User read
+            'mongo_reads_saved': self.hits
+        }
+
+
+device_tokens = DeviceTokenCache()
+
+
+def _user_saved(sender, document, **kwargs):
+    # the saved document may be a projection without devices, the next delivery reloads them
+    device_tokens.invalidate(document.UserPhone)
+
+
+def connect_signals():
+    """
+    Invalidates the cached tokens of every saved user. Devices are registered by the Api
+    processes, so it has to be called there rather than in the APNS service.
+    """
+    if signals.signals_available:
+        signals.post_save.connect(_user_saved, sender=User)
+    else:
+        get_custom_logger().error('blinker is not installed, device tokens are only refreshed by their TTL')
@@ -1,17 +1,32 @@
 import json
 import os
 import random
+import socket
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Process
+from time import time
 
 import redis
 from apns import APNs, Payload, PayloadAlert
-from mongoengine import DoesNotExist
+from pymongo.errors import AutoReconnect
 
 from Api.models import User
 from togetherapi.locks.lock import FileLock
 from togetherapi.notifications import APNS_QUEUE_CHANNEL, APNS_SERVER_CERT_SANDBOX, APNS_SERVER_KEY_SANDBOX
+from togetherapi.notifications.devices import device_tokens, device_tokens_of
+from togetherapi.notifications.queue import APNS_DELIVERY_MODE, APNS_STREAM_KEY, APNS_CONSUMER_GROUP, APNS_WORKERS, \
+    APNS_WORKER_CONCURRENCY, APNS_CLAIM_IDLE, APNS_BLOCK_TIMEOUT, APNS_BATCH_SIZE, APNS_MAX_ATTEMPTS, APNS_STATS_KEY, \
+    APNS_SHUTDOWN_TIMEOUT, ensure_group, entry_message, entry_attempts, entry_age, schedule_retry, \
+    promote_due_retries, dead_letter, shutdown_generation, request_shutdown, client as queue_client
+from togetherapi.notifications.unread import unread_counters, count_unread, UNREAD_BADGE_ENABLED, \
+    UNREAD_RECONCILE_INTERVAL
+from togetherapi.helpers import percentile
 from togetherapi.utils import singleton, get_custom_logger
 
+# failures worth another attempt, any other error dead-letters the job right away
+TRANSIENT_ERRORS = (socket.error, AutoReconnect, redis.ConnectionError, redis.TimeoutError)
+
 
 class NotificationServiceBase:
     def __init__(self, certfile, channel, keyfile=None):
@@ -22,13 +37,21 @@ class NotificationServiceBase:
         self.channel = channel
         self.logger = get_custom_logger()
         self.logger.debug("Certificate file set: %s" % self.certfile)
-        self.lock = FileLock('notification_lock')
+        # the consumer group shares the queue between workers, only the pubsub listener has to be unique
+        self.lock = FileLock('notification_lock') if APNS_DELIVERY_MODE != 'stream' else None
+        self.consumer = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.delivered = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.batches = deque(maxlen=1000)
         if os.access(APNS_SERVER_CERT_SANDBOX, os.R_OK | os.F_OK):
             self.logger.debug('Access to APNS certificate is ok')
         else:
             self.logger.error('Count not open cert. file. Service will not operate properly!!!')
-    
+
     def run_server(self):
+        if APNS_DELIVERY_MODE == 'stream':
+            return self.run_consumer()
         self.lock.acquire()
         print 'Lock handle obtained'
         self.pubsub.subscribe((self.channel,))
@@ -40,28 +63,192 @@ class NotificationServiceBase:
             else:
                 self.on_message(item)
 
+    def run_consumer(self, batch_size=APNS_BATCH_SIZE, concurrency=APNS_WORKER_CONCURRENCY):
+        """
+        Delivers the notifications of the shared stream in batches as a member of the consumer group.
+        Transient failures are retried with exponential backoff, other ones and jobs out of attempts
+        are dead-lettered. Entries left pending by a dead worker are claimed after APNS_CLAIM_IDLE.
+        The consumer stops once request_shutdown is called, a KILL entry requests it for the whole group.
+        :param batch_size: maximum number of entries read at once
+        :param concurrency: number of notifications of a batch delivered at once
+        """
+        ensure_group(self.redis)
+        executor = ThreadPoolExecutor(concurrency)
+        print 'Consumer %s joined the group %s' % (self.consumer, APNS_CONSUMER_GROUP)
+        generation = shutdown_generation(self.redis)
+        last_claim = 0
+        while shutdown_generation(self.redis) == generation:
+            promote_due_retries(batch_size, connection=self.redis)
+            if time() - last_claim >= APNS_CLAIM_IDLE:
+                entries = self._claim_stale(batch_size)
+                last_claim = time()
+            else:
+                entries = self._read(batch_size)
+            # a KILL entry reaches a single consumer of the group
+            if entries and not self._process_batch(executor, entries):
+                request_shutdown(self.redis)
+        executor.shutdown(wait=True)
+        print self, "Consumer process is going to be terminated"
+
+    def _read(self, count):
+        reply = self.redis.execute_command('XREADGROUP', 'GROUP', APNS_CONSUMER_GROUP, self.consumer,
+                                           'COUNT', count, 'BLOCK', APNS_BLOCK_TIMEOUT * 1000,
+                                           'STREAMS', APNS_STREAM_KEY, '>')
+        return reply[0][1] if reply else []
+
+    def _claim_stale(self, count):
+        """
+        Takes over the entries other consumers have not acknowledged for APNS_CLAIM_IDLE seconds.
+        Entries delivered APNS_MAX_ATTEMPTS times are likely to bring their worker down and are dead-lettered.
+        """
+        min_idle = APNS_CLAIM_IDLE * 1000
+        pending = self.redis.xpending_range(APNS_STREAM_KEY, APNS_CONSUMER_GROUP, '-', '+', count)
+        deliveries = dict((entry['message_id'], entry['times_delivered']) for entry in pending
+                          if entry['consumer'] != self.consumer and entry['time_since_delivered'] >= min_idle)
+        if not deliveries:
+            return []
+        claimed = self.redis.xclaim(APNS_STREAM_KEY, APNS_CONSUMER_GROUP, self.consumer, min_idle, deliveries.keys())
+        entries = []
+        crashed = []
+        for entry in claimed:
+            # entries trimmed from the stream meanwhile are claimed without their fields
+            if entry is None or entry[1] is None:
+                continue
+            if deliveries.get(entry[0], 0) >= APNS_MAX_ATTEMPTS:
+                crashed.append(entry)
+            else:
+                entries.append(entry)
+        if crashed:
+            pipe = self.redis.pipeline()
+            for entry_id, fields in crashed:
+                dead_letter(entry_id, entry_message(fields), deliveries[entry_id],
+                            RuntimeError('worker died while delivering'), pipe=pipe)
+            pipe.execute_command('XACK', APNS_STREAM_KEY, APNS_CONSUMER_GROUP, *[entry[0] for entry in crashed])
+            pipe.execute()
+            self.dead_lettered += len(crashed)
+        self.logger.debug('Consumer %s claimed %d stale notifications' % (self.consumer, len(claimed)))
+        return entries
+
+    def _attempt(self, job):
+        entry_id, message, attempts = job
+        try:
+            self.handle_message(message)
+            return None
+        except BaseException, e:
+            return e
+
+    def _process_batch(self, executor, entries):
+        """
+        Delivers a batch and acknowledges it along with the retries and dead letters it has caused
+        :return: False when the batch carries the KILL command
+        """
+        started = time()
+        running = True
+        jobs = []
+        for entry_id, fields in entries:
+            message = entry_message(fields)
+            if message == "KILL":
+                running = False
+            else:
+                jobs.append((entry_id, message, entry_attempts(fields)))
+        outcomes = list(executor.map(self._attempt, jobs))
+
+        delivered = retried = dead = 0
+        pipe = self.redis.pipeline()
+        for (entry_id, message, attempts), error in zip(jobs, outcomes):
+            if error is None:
+                delivered += 1
+            elif isinstance(error, TRANSIENT_ERRORS) and attempts < APNS_MAX_ATTEMPTS:
+                self.logger.debug('Notification %s failed on attempt %d: %s' % (entry_id, attempts, error))
+                schedule_retry(self._undelivered_part(message, error), attempts + 1, pipe=pipe)
+                retried += 1
+            else:
+                self.logger.error('Notification %s dead-lettered after %d attempts: %s' % (entry_id, attempts, error))
+                dead_letter(entry_id, message, attempts, error, pipe=pipe)
+                dead += 1
+        pipe.execute_command('XACK', APNS_STREAM_KEY, APNS_CONSUMER_GROUP, *[entry[0] for entry in entries])
+        elapsed = time() - started
+        pipe.hincrby(APNS_STATS_KEY, 'batches', 1)
+        pipe.hincrby(APNS_STATS_KEY, 'delivered', delivered)
+        pipe.hincrby(APNS_STATS_KEY, 'retried', retried)
+        pipe.hincrby(APNS_STATS_KEY, 'dead_lettered', dead)
+        pipe.hincrbyfloat(APNS_STATS_KEY, 'seconds', elapsed)
+        pipe.execute()
+
+        self.delivered += delivered
+        self.retried += retried
+        self.dead_lettered += dead
+        batch = {
+            'size': len(entries),
+            'seconds': elapsed,
+            'throughput': len(entries) / elapsed if elapsed else None,
+            'max_queued': max(entry_age(entry[0]) for entry in entries)
+        }
+        self.batches.append(batch)
+        self.logger.debug('APNS batch of %(size)d delivered in %(seconds).3fs, oldest entry queued %(max_queued).1fs'
+                          % batch)
+        return running
+
+    @staticmethod
+    def _undelivered_part(message, error):
+        """
+        :return: the message narrowed down to the recipients a failed fan-out has not reached
+        """
+        undelivered = getattr(error, 'undelivered', None)
+        if undelivered is None:
+            return message
+        message = json.loads(message)
+        message['MessageRcpts'] = undelivered
+        return json.dumps(message)
+
+    def stats(self):
+        seconds = sorted(batch['seconds'] for batch in self.batches)
+        sizes = sum(batch['size'] for batch in self.batches)
+        return {
+            'delivered': self.delivered,
+            'retried': self.retried,
+            'dead_lettered': self.dead_lettered,
+            'batches': len(self.batches),
+            'throughput': sizes / sum(seconds) if seconds and sum(seconds) else None,
+            'batch_p50': percentile(seconds, 50),
+            'batch_p99': percentile(seconds, 99)
+        }
+
     def _deliver_message(self, msg, mem, mem_to, loc_key, custom=None):
         pass
 
+    def _deliver_fanout(self, msg, mem, rcpts, loc_key, custom=None):
+        for mem_to in rcpts:
+            self._deliver_message(msg, mem, mem_to, loc_key, custom)
+
     def on_message(self, packed_object):
         try:
             if isinstance(packed_object, dict) and packed_object['data'] == 1:
                 return
-            message = json.loads(packed_object['data'])
-            if message.get('MessageAuthor'):
-                member = message['MessageAuthor']
-            else:
-                member = message['CommentAuthor']
-            member_to = message['MessageRcpt']
-            loc_key = message['loc-key']
-            if loc_key == 'KEY_NEW_MESSAGE':
-                custom = {'EventType': message['EventType']}
-            else:
-                custom = None
-            self._deliver_message(message, member, member_to, loc_key, custom)
+            self.handle_message(packed_object['data'])
         except BaseException, e:
             self.logger.error(e)
 
+    def handle_message(self, data):
+        """
+        Decodes and delivers a queued notification, errors are raised to the caller. A notification
+        carries either a single MessageRcpt or a MessageRcpts list fanning it out to many members.
+        """
+        message = json.loads(data)
+        if message.get('MessageAuthor'):
+            member = message['MessageAuthor']
+        else:
+            member = message['CommentAuthor']
+        loc_key = message['loc-key']
+        if loc_key == 'KEY_NEW_MESSAGE':
+            custom = {'EventType': message['EventType']}
+        else:
+            custom = None
+        if 'MessageRcpts' in message:
+            self._deliver_fanout(message, member, message['MessageRcpts'], loc_key, custom)
+        else:
+            self._deliver_message(message, member, message['MessageRcpt'], loc_key, custom)
+
     def __del__(self):
         if self.lock is not None:
             self.lock.release()
@@ -88,6 +275,8 @@ class AppleNotificationService(NotificationServiceBase):
         Performs service startup
         """
         self.logger.debug("APNS notification service has subscribed on the channel: %s" % self.channel)
+        if UNREAD_BADGE_ENABLED and UNREAD_RECONCILE_INTERVAL:
+            unread_counters.start_reconciler(UNREAD_RECONCILE_INTERVAL)
         NotificationServiceBase.run_server(self)
 
     def _response_listener(self, error_response):
@@ -100,46 +289,81 @@ class AppleNotificationService(NotificationServiceBase):
         :param mem: member who sends a messaged
         :param mem_to: member for whom the message is being delivered
         """
-        try:
-            user = User.objects.get(UserPhone=mem_to['UserPhone'])
-            events = user.get_events()
-            total_unread = 0
-            for e in events:
-                member_data = e.get_member_data(user)
-                total_unread += member_data.UserUnreadMessages + member_data.FeedUnreadMessages \
-                    if member_data.FeedUnreadMessages is not None \
-                    else member_data.UserUnreadMessages
-            self.logger.debug('Total unread messages: %d' % total_unread)
-            for device in user.UserDevices:
-                if device.DeviceCMToken is not None and len(device.DeviceCMToken) > 0:
-                    alert = None
-                    member_name_to = ''.join([mem['UserFirstName'], u' ', mem['UserLastName']])
-                    if msg.get('MessageText'):
-                        alert = PayloadAlert(loc_key=loc_key, loc_args=[member_name_to, msg['MessageText']])
-                    elif msg.get('CommentText'):
-                        alert = PayloadAlert(loc_key=loc_key, loc_args=[member_name_to, msg['CommentText']])
-                    elif loc_key == 'KEY_YOU_INVITED':
-                        alert = PayloadAlert(loc_key=loc_key, loc_args=[member_name_to, msg['EventName']])
-                    elif loc_key == 'KEY_REQUEST_SUBSCRIBE':
-                        alert = PayloadAlert(loc_key=loc_key, loc_args=[member_name_to])
-
-                    payload = Payload(
-                        alert=alert,
-                        sound='sound1.caf',
-                        badge=total_unread,
-                        custom={
-                            'EventId': msg.get('EventId'),
-                            'EventType': custom.get('EventType') if custom is not None else None
-                        })
+        self._deliver_fanout(msg, mem, [mem_to], loc_key, custom)
+
+    @staticmethod
+    def _build_alert(msg, mem, loc_key):
+        member_name_to = ''.join([mem['UserFirstName'], u' ', mem['UserLastName']])
+        if msg.get('MessageText'):
+            return PayloadAlert(loc_key=loc_key, loc_args=[member_name_to, msg['MessageText']])
+        elif msg.get('CommentText'):
+            return PayloadAlert(loc_key=loc_key, loc_args=[member_name_to, msg['CommentText']])
+        elif loc_key == 'KEY_YOU_INVITED':
+            return PayloadAlert(loc_key=loc_key, loc_args=[member_name_to, msg['EventName']])
+        elif loc_key == 'KEY_REQUEST_SUBSCRIBE':
+            return PayloadAlert(loc_key=loc_key, loc_args=[member_name_to])
+        return None
+
+    def _deliver_fanout(self, msg, mem, rcpts, loc_key, custom=None):
+        """
+        Sends one notification to many members, the alert is built once and only the badge differs
+        :param msg: message object
+        :param mem: member who sends a messaged
+        :param rcpts: members for whom the message is being delivered
+        """
+        phones = [mem_to['UserPhone'] for mem_to in rcpts]
+        tokens, badges = self._load_recipients(phones)
+        missing = set(phones) - set(tokens)
+        if missing:
+            self.logger.error("Users %s were not found. Unable to deliver the notification." % ', '.join(missing))
+        # users without devices need no payload
+        phones = [phone for phone in tokens if tokens[phone]]
+        if not phones:
+            return
+        alert = self._build_alert(msg, mem, loc_key)
+        custom = {
+            'EventId': msg.get('EventId'),
+            'EventType': custom.get('EventType') if custom is not None else None
+        }
+        payloads = {}
+        delivered = set()
+        for phone in phones:
+            badge = badges.get(phone, 0)
+            if badge not in payloads:
+                payloads[badge] = Payload(alert=alert, sound='sound1.caf', badge=badge, custom=custom)
+            try:
+                for token in tokens[phone]:
                     identifier = random.getrandbits(32)
-                    self.logger.debug('Sending payload to APNS with device token: %s' % device.DeviceCMToken)
-                    self.endpoint.gateway_server.send_notification(device.DeviceCMToken.replace(' ', ''), payload,
-                                                                   identifier=identifier)
-        except BaseException, e:
-            if e is DoesNotExist:
-                self.logger.error("User %s was not found. Unable to deliver the notification." % mem_to['UserPhone'])
-            else:
-                self.logger.error("Unexpected error occurred:%s" % e.message)
+                    self.logger.debug('Sending payload to APNS with device token: %s' % token)
+                    self.endpoint.gateway_server.send_notification(token, payloads[badge], identifier=identifier)
+            except BaseException, e:
+                # a retry must not push again to the members who already got the notification
+                e.undelivered = [mem_to for mem_to in rcpts if mem_to['UserPhone'] not in delivered]
+                raise
+            delivered.add(phone)
+        self.logger.debug('Notification delivered to %d users with %d distinct badges' % (len(phones), len(payloads)))
+
+    @staticmethod
+    def _load_recipients(phones):
+        """
+        :return: (tokens, badges) dicts mapping the phone of every existing recipient to its device tokens and badge
+        """
+        if not unread_counters.enabled:
+            # the badge is summed from the User document anyway, so one query serves the devices as well
+            users = list(User.objects(UserPhone__in=list(set(phones))))
+            return (dict((user.UserPhone, device_tokens_of(user)) for user in users),
+                    dict((user.UserPhone, sum(count_unread(user).itervalues())) for user in users))
+        loaded = {}
+        badges = unread_counters.badges(phones, loaded)
+        # users read from Mongo to seed their counters are not read again for their devices
+        tokens = {}
+        for phone, user in loaded.iteritems():
+            tokens[phone] = device_tokens_of(user)
+            device_tokens.refresh(user)
+        remaining = [phone for phone in phones if phone not in loaded]
+        if remaining:
+            tokens.update(device_tokens.get_many(remaining))
+        return tokens, badges
 
     def __del__(self):
         self.logger.debug("APNS notification service service unsubscribed from channel: %s" % self.channel)
@@ -149,7 +373,7 @@ class AppleNotificationService(NotificationServiceBase):
 @singleton
 class ApnsServiceRunner:
     def __init__(self):
-        self.proc_handler = None
+        self.proc_handlers = []
         self.logger = get_custom_logger()
         self.logger.debug('APNS service runner initialized')
 
@@ -159,11 +383,33 @@ class ApnsServiceRunner:
         apns_server.run_server()
         self.logger.debug('***  APNS Service Started  ***')
 
-    def run_server(self):
-        p = Process(target=self._proc_runner)
-        self.proc_handler = p
-        p.start()
+    def run_server(self, workers=APNS_WORKERS):
+        """
+        :param workers: number of worker processes, only the stream delivery mode runs more than one
+        """
+        if APNS_DELIVERY_MODE != 'stream':
+            workers = 1
+        for index in range(workers):
+            p = Process(target=self._proc_runner, name='apns-worker-%d' % index)
+            self.proc_handlers.append(p)
+            p.start()
+
+    def stop_server(self, timeout=APNS_SHUTDOWN_TIMEOUT):
+        """
+        Stops the workers of this runner, in stream mode the consumers on every other host as well
+        """
+        if APNS_DELIVERY_MODE == 'stream':
+            request_shutdown()
+        else:
+            queue_client.publish(APNS_QUEUE_CHANNEL, "KILL")
+        for p in self.proc_handlers:
+            p.join(timeout)
+            if p.is_alive():
+                self.logger.error('APNS worker %d did not stop in time, terminating it' % p.pid)
+                p.terminate()
+                p.join()
+        self.proc_handlers = []
 
     def __del__(self):
-        if self.proc_handler is not None:
-            self.proc_handler.join()
+        for p in self.proc_handlers:
+            p.join()
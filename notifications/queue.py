@@ -0,0 +1,202 @@
+import json
+import random
+import uuid
+from time import time
+
+import redis
+
+from togetherapi import settings
+from togetherapi.notifications import APNS_QUEUE_CHANNEL
+
+__author__ = 'arclite'
+
+# 'pubsub' keeps the single FileLock guarded listener, 'stream' shares a Redis stream between worker processes
+APNS_DELIVERY_MODE = getattr(settings, 'APNS_DELIVERY_MODE', 'pubsub')
+APNS_STREAM_KEY = getattr(settings, 'APNS_STREAM_KEY', 'apns:queue')
+APNS_STREAM_MAXLEN = getattr(settings, 'APNS_STREAM_MAXLEN', 100000)
+APNS_CONSUMER_GROUP = getattr(settings, 'APNS_CONSUMER_GROUP', 'apns')
+# worker processes started on this host and notifications each of them delivers at once
+APNS_WORKERS = getattr(settings, 'APNS_WORKERS', 1)
+APNS_WORKER_CONCURRENCY = getattr(settings, 'APNS_WORKER_CONCURRENCY', 8)
+# pending entries idle for that long belong to a dead worker and are claimed by a live one
+APNS_CLAIM_IDLE = getattr(settings, 'APNS_CLAIM_IDLE', 60)
+APNS_BLOCK_TIMEOUT = getattr(settings, 'APNS_BLOCK_TIMEOUT', 5)
+APNS_BATCH_SIZE = getattr(settings, 'APNS_BATCH_SIZE', 50)
+# transient failures are retried with exponential backoff, after the last attempt a job is dead-lettered
+APNS_MAX_ATTEMPTS = getattr(settings, 'APNS_MAX_ATTEMPTS', 5)
+APNS_RETRY_BASE = getattr(settings, 'APNS_RETRY_BASE', 2)
+APNS_RETRY_MAX = getattr(settings, 'APNS_RETRY_MAX', 300)
+APNS_RETRY_KEY = getattr(settings, 'APNS_RETRY_KEY', 'apns:retry')
+APNS_DEAD_LETTER_KEY = getattr(settings, 'APNS_DEAD_LETTER_KEY', 'apns:dead')
+APNS_DEAD_LETTER_MAXLEN = getattr(settings, 'APNS_DEAD_LETTER_MAXLEN', 10000)
+APNS_STATS_KEY = getattr(settings, 'APNS_STATS_KEY', 'apns:stats')
+# bumped to stop every consumer of the group, each of them compares it with the value seen at startup
+APNS_SHUTDOWN_KEY = getattr(settings, 'APNS_SHUTDOWN_KEY', 'apns:shutdown')
+APNS_SHUTDOWN_TIMEOUT = getattr(settings, 'APNS_SHUTDOWN_TIMEOUT', 30)
+
+# moves the retries which are due back to the stream, jobs are stored as <attempts>:<nonce>:<message>
+_PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, job in ipairs(due) do
+    local attempts, message = string.match(job, '^(%d+):[^:]*:(.*)$')
+    redis.call('XADD', KEYS[2], 'MAXLEN', '~', ARGV[2], '*', 'm', message, 'a', attempts)
+    redis.call('ZREM', KEYS[1], job)
+end
+return #due
+"""
+
+client = redis.Redis()
+_promote_script = client.register_script(_PROMOTE_SCRIPT)
+
+
+def enqueue_notification(message, pipe=None):
+    """
+    Queues a notification for the APNS service in the configured delivery mode
+    :param message: notification dict or its JSON encoding
+    :param pipe: pipeline to queue the command on instead of sending it right away
+    :return: stream id of the entry or the number of subscribers in pubsub mode
+    """
+    target = pipe if pipe is not None else client
+    if not isinstance(message, basestring):
+        message = json.dumps(message)
+    if APNS_DELIVERY_MODE != 'stream':
+        return target.publish(APNS_QUEUE_CHANNEL, message)
+    return target.execute_command('XADD', APNS_STREAM_KEY, 'MAXLEN', '~', APNS_STREAM_MAXLEN, '*', 'm', message)
+
+
+def ensure_group(connection=None):
+    """
+    Creates the consumer group along with the stream unless it exists. New groups start at the
+    beginning of the stream, so the entries queued before the first worker came up are delivered.
+    """
+    try:
+        (connection or client).xgroup_create(APNS_STREAM_KEY, APNS_CONSUMER_GROUP, id='0', mkstream=True)
+    except redis.ResponseError, e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+
+
+def shutdown_generation(connection=None):
+    return int((connection or client).get(APNS_SHUTDOWN_KEY) or 0)
+
+
+def request_shutdown(connection=None):
+    """
+    Stops every consumer currently running on any host, consumers started afterwards keep running
+    """
+    return (connection or client).incr(APNS_SHUTDOWN_KEY)
+
+
+def entry_fields(fields):
+    """
+    :param fields: flat field/value list of a stream entry or the dict newer redis-py versions parse it into
+    """
+    if isinstance(fields, dict):
+        return fields
+    return dict(zip(fields[::2], fields[1::2]))
+
+
+def entry_message(fields):
+    return entry_fields(fields).get('m')
+
+
+def entry_attempts(fields):
+    """
+    :return: number of the delivery attempt the entry stands for
+    """
+    return int(entry_fields(fields).get('a', 1))
+
+
+def entry_age(entry_id):
+    """
+    :return: seconds since the entry was added to the stream
+    """
+    return time() - int(entry_id.split('-')[0]) / 1000.0
+
+
+def backoff(attempts):
+    """
+    :return: seconds to wait before the given attempt, doubling from APNS_RETRY_BASE with some jitter
+    """
+    delay = min(APNS_RETRY_BASE * 2 ** (attempts - 2), APNS_RETRY_MAX)
+    return delay / 2.0 + random.uniform(0, delay / 2.0)
+
+
+def schedule_retry(message, attempts, pipe=None):
+    """
+    :param attempts: number of the upcoming attempt
+    """
+    target = pipe if pipe is not None else client
+    job = '%d:%s:%s' % (attempts, uuid.uuid4().hex, message)
+    return target.execute_command('ZADD', APNS_RETRY_KEY, time() + backoff(attempts), job)
+
+
+def promote_due_retries(limit=APNS_BATCH_SIZE, connection=None):
+    """
+    :return: number of retries put back to the stream
+    """
+    return _promote_script(keys=[APNS_RETRY_KEY, APNS_STREAM_KEY], args=[time(), APNS_STREAM_MAXLEN, limit],
+                           client=connection or client)
+
+
+def dead_letter(entry_id, message, attempts, error, pipe=None):
+    target = pipe if pipe is not None else client
+    target.lpush(APNS_DEAD_LETTER_KEY, json.dumps({
+        'id': entry_id,
+        'message': message,
+        'attempts': attempts,
+        'error': '%s: %s' % (type(error).__name__, error),
+        'failed': time()
+    }))
+    target.ltrim(APNS_DEAD_LETTER_KEY, 0, APNS_DEAD_LETTER_MAXLEN - 1)
+
+
+def dead_letters(start=0, count=100):
+    """
+    :return: dead-lettered jobs, newest first
+    """
+    return [json.loads(job) for job in client.lrange(APNS_DEAD_LETTER_KEY, start, start + count - 1)]
+
+
+def requeue_dead_letters(count=APNS_DEAD_LETTER_MAXLEN):
+    """
+    Puts the oldest dead-lettered jobs back to the stream with a fresh attempt count
+    :return: number of jobs requeued
+    """
+    requeued = 0
+    while requeued < count:
+        job = client.rpop(APNS_DEAD_LETTER_KEY)
+        if job is None:
+            break
+        enqueue_notification(json.loads(job)['message'])
+        requeued += 1
+    return requeued
+
+
+def queue_stats():
+    """
+    :return: totals of all workers along with the entries being delivered, waiting for a retry or dead
+    """
+    pipe = client.pipeline(transaction=False)
+    pipe.hgetall(APNS_STATS_KEY)
+    pipe.xpending(APNS_STREAM_KEY, APNS_CONSUMER_GROUP)
+    pipe.zcard(APNS_RETRY_KEY)
+    pipe.llen(APNS_DEAD_LETTER_KEY)
+    totals, pending, retrying, dead = pipe.execute()
+    stats = dict((name, float(value)) for name, value in totals.iteritems())
+    stats.update({'pending': pending['pending'], 'retrying': retrying, 'dead_letters': dead})
+    return stats
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='APNS queue inspection')
+    parser.add_argument('--dead-letters', type=int, default=0, help='number of dead letters to print')
+    parser.add_argument('--requeue', action='store_true', help='put the dead letters back to the queue')
+    args = parser.parse_args()
+    print json.dumps(queue_stats(), indent=2)
+    for job in dead_letters(count=args.dead_letters):
+        print json.dumps(job)
+    if args.requeue:
+        print 'Requeued: %d' % requeue_dead_letters()
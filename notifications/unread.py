@@ -0,0 +1,326 @@
+"""
+Per user unread counters backing the APNS badge. Every user owns a hash holding the unread
+chat (u:<event id>) and feed (f:<event id>) messages of its events plus their running total,
+so a badge is a single HGET instead of a walk over all events of the user.
+
+The hash is seeded from Mongo the first time a badge is needed and kept up to date by
+message_created/messages_read, which only touch hashes that are already seeded. Seeding
+records the user as a member of each of its events, so a new message only needs its event.
+Every saved Message is counted through the post_save signal, reads have to call
+messages_read. The reconciliation job rewrites the seeded hashes from Mongo to correct any
+drift, e.g. events joined after seeding or reads made by queryset updates.
+
+Usage: DJANGO_SETTINGS_MODULE=togetherapi.settings python -m togetherapi.notifications.unread
+"""
+import os
+import threading
+from time import sleep
+
+import redis
+from mongoengine import signals
+
+from Api.models import Message, User
+from togetherapi import settings
+from togetherapi.utils import get_custom_logger
+
+__author__ = 'arclite'
+
+# off sums the badges from Mongo as before
+UNREAD_BADGE_ENABLED = getattr(settings, 'UNREAD_BADGE_ENABLED', True)
+UNREAD_KEY = getattr(settings, 'UNREAD_KEY', 'unread:%s')
+# phones of the seeded members of an event, kept outside the UNREAD_KEY namespace the reconciliation scans
+UNREAD_MEMBERS_KEY = getattr(settings, 'UNREAD_MEMBERS_KEY', 'unread-members:%s')
+# counters of users without new messages expire and are seeded again on demand
+UNREAD_TTL = getattr(settings, 'UNREAD_TTL', 30 * 24 * 60 * 60)
+UNREAD_RECONCILE_INTERVAL = getattr(settings, 'UNREAD_RECONCILE_INTERVAL', 15 * 60)
+UNREAD_RECONCILE_BATCH = getattr(settings, 'UNREAD_RECONCILE_BATCH', 200)
+# taken for a whole interval by the worker which reconciles, so one run per interval happens across all hosts
+UNREAD_RECONCILE_LOCK = getattr(settings, 'UNREAD_RECONCILE_LOCK', 'unread-reconcile-lock')
+
+TOTAL = 'total'
+# bumped by every change of a hash, a reconciliation only replaces hashes nobody changed meanwhile
+VERSION = 'v'
+
+# adds to the event counter and the total of every seeded member of the event but the author
+_INCR_SCRIPT = """
+local count = 0
+for _, phone in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    local key = ARGV[5] .. phone
+    if phone ~= ARGV[4] and redis.call('HEXISTS', key, ARGV[1]) == 1 then
+        redis.call('HINCRBY', key, ARGV[1], ARGV[2])
+        redis.call('HINCRBY', key, 'total', ARGV[2])
+        redis.call('HINCRBY', key, 'v', 1)
+        redis.call('EXPIRE', key, ARGV[3])
+        count = count + 1
+    end
+end
+return count
+"""
+
+# clears event counters and subtracts them from the total of a seeded hash, returns the new total
+_READ_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return nil
+end
+local total = tonumber(redis.call('HGET', KEYS[1], 'total') or 0)
+for i = 2, #ARGV do
+    local count = redis.call('HGET', KEYS[1], ARGV[i])
+    if count then
+        total = total - tonumber(count)
+        redis.call('HSET', KEYS[1], ARGV[i], 0)
+    end
+end
+if total < 0 then
+    total = 0
+end
+redis.call('HSET', KEYS[1], 'total', total)
+redis.call('HINCRBY', KEYS[1], 'v', 1)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return total
+"""
+
+# replaces the hash with counters computed from Mongo unless its version differs from the one read
+# before Mongo was queried, an empty version stands for a missing hash. Returns the resulting total.
+_SEED_SCRIPT = """
+local version = redis.call('HGET', KEYS[1], 'v')
+if (version or '') ~= ARGV[2] then
+    return redis.call('HGET', KEYS[1], 'total')
+end
+redis.call('DEL', KEYS[1])
+local total = 0
+for i = 5, #ARGV, 2 do
+    total = total + tonumber(ARGV[i + 1])
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    local members = ARGV[3] .. string.sub(ARGV[i], 3)
+    redis.call('SADD', members, ARGV[4])
+    redis.call('EXPIRE', members, ARGV[1])
+end
+redis.call('HSET', KEYS[1], 'total', total)
+redis.call('HSET', KEYS[1], 'v', (tonumber(version) or 0) + 1)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return total
+"""
+
+
+def _field(event_id, feed):
+    return '%s:%s' % ('f' if feed else 'u', event_id)
+
+
+def count_unread(user):
+    """
+    Reads the unread counters of every event of the user from Mongo
+    :return: dict mapping hash fields to counts
+    """
+    counts = {}
+    for event in user.get_events():
+        member_data = event.get_member_data(user)
+        counts[_field(event.EventId, False)] = member_data.UserUnreadMessages or 0
+        counts[_field(event.EventId, True)] = member_data.FeedUnreadMessages or 0
+    return counts
+
+
+class UnreadCounters(object):
+    def __init__(self, client=None, ttl=UNREAD_TTL, enabled=UNREAD_BADGE_ENABLED):
+        """
+        :param client: redis client, a new one is created if omitted
+        :param ttl: seconds a hash lives without being updated
+        :param enabled: whether badges are read from the counters rather than summed from Mongo
+        """
+        self.redis = client if client is not None else redis.Redis()
+        self.ttl = ttl
+        self.enabled = enabled
+        self.logger = get_custom_logger()
+        self._incr = self.redis.register_script(_INCR_SCRIPT)
+        self._read = self.redis.register_script(_READ_SCRIPT)
+        self._seed = self.redis.register_script(_SEED_SCRIPT)
+        self.hits = 0
+        self.seeded = 0
+
+    def message_created(self, event_id, author_phone=None, feed=False, amount=1):
+        """
+        Counts a new unread message for every member of the event but its author
+        :param feed: whether it is a feed message rather than a chat one
+        """
+        try:
+            self._incr(keys=[UNREAD_MEMBERS_KEY % event_id],
+                       args=[_field(event_id, feed), amount, self.ttl, author_phone or '', UNREAD_KEY % ''])
+        except redis.RedisError, e:
+            self.logger.error('Unable to count unread message of event %s: %s' % (event_id, e))
+
+    def messages_read(self, phone, event_id, feed=None):
+        """
+        Clears the unread messages of an event, call it along with the Mongo update
+        :param feed: True or False to clear feed or chat messages only, None to clear both
+        :return: the new total or None if the user has no counters yet
+        """
+        kinds = (False, True) if feed is None else (feed,)
+        try:
+            return self._read(keys=[UNREAD_KEY % phone], args=[self.ttl] + [_field(event_id, f) for f in kinds])
+        except redis.RedisError, e:
+            self.logger.error('Unable to clear unread messages of %s: %s' % (phone, e))
+            return None
+
+    def seed(self, user, counts=None, version=None):
+        """
+        Replaces the counters of the user with the ones stored in Mongo
+        :param counts: counters computed from the full User document, without them the user
+        is reloaded, as a projected document would seed a wrong total for the whole TTL
+        :param version: version of the hash read before Mongo was queried, None if there was no hash.
+        A hash changed meanwhile is kept, as Mongo may predate the change.
+        :return: total number of unread messages
+        """
+        if counts is None:
+            counts = count_unread(User.objects.get(UserPhone=user.UserPhone))
+        args = [self.ttl, version or '', UNREAD_MEMBERS_KEY % '', user.UserPhone]
+        for field, count in counts.iteritems():
+            args.extend((field, count))
+        self.seeded += 1
+        total = self._seed(keys=[UNREAD_KEY % user.UserPhone], args=args)
+        return int(total) if total is not None else sum(counts.itervalues())
+
+    def badge(self, user):
+        """
+        Total number of unread messages of the user, seeding its counters on first use
+        """
+        if not self.enabled:
+            return sum(count_unread(user).itervalues())
+        try:
+            total = self.redis.hget(UNREAD_KEY % user.UserPhone, TOTAL)
+            if total is not None:
+                self.hits += 1
+                return int(total)
+            return self.seed(user)
+        except redis.RedisError, e:
+            self.logger.error('Unable to read unread counters of %s: %s' % (user.UserPhone, e))
+            return sum(count_unread(user).itervalues())
+
+    def _seed_loaded(self, user):
+        counts = count_unread(user)
+        try:
+            return self.seed(user, counts)
+        except redis.RedisError, e:
+            self.logger.error('Unable to seed unread counters of %s: %s' % (user.UserPhone, e))
+            return sum(counts.itervalues())
+
+    def badges(self, phones, loaded=None):
+        """
+        Bulk badge query reading all seeded counters in one round trip, only the users
+        whose counters are not seeded yet are loaded from Mongo
+        :param loaded: dict receiving the User documents read from Mongo by phone, so the caller
+        does not read them again
+        :return: dict mapping the phone of every existing user to its badge
+        """
+        if not self.enabled:
+            return dict((user.UserPhone, sum(count_unread(user).itervalues()))
+                        for user in User.objects(UserPhone__in=phones))
+        phones = list(phones)
+        pipe = self.redis.pipeline(transaction=False)
+        for phone in phones:
+            pipe.hget(UNREAD_KEY % phone, TOTAL)
+        try:
+            totals = pipe.execute()
+        except redis.RedisError, e:
+            self.logger.error('Unable to read unread counters: %s' % e)
+            totals = [None] * len(phones)
+        badges = {}
+        missing = []
+        for phone, total in zip(phones, totals):
+            if total is not None:
+                self.hits += 1
+                badges[phone] = int(total)
+            else:
+                missing.append(phone)
+        if missing:
+            for user in User.objects(UserPhone__in=missing):
+                badges[user.UserPhone] = self._seed_loaded(user)
+                if loaded is not None:
+                    loaded[user.UserPhone] = user
+        return badges
+
+    def reconcile(self, batch_size=UNREAD_RECONCILE_BATCH):
+        """
+        Rewrites every seeded hash from Mongo, users without counters are seeded lazily anyway
+        :return: number of users reconciled
+        """
+        prefix = UNREAD_KEY % ''
+        reconciled = 0
+        phones = []
+        for key in self.redis.scan_iter(match=UNREAD_KEY % '*', count=batch_size):
+            phones.append(key[len(prefix):])
+            if len(phones) >= batch_size:
+                reconciled += self._reconcile_batch(phones)
+                phones = []
+        if phones:
+            reconciled += self._reconcile_batch(phones)
+        self.logger.debug('Unread counters of %d users reconciled' % reconciled)
+        return reconciled
+
+    def _reconcile_batch(self, phones):
+        pipe = self.redis.pipeline(transaction=False)
+        for phone in phones:
+            pipe.hget(UNREAD_KEY % phone, VERSION)
+        versions = dict(zip(phones, pipe.execute()))
+        reconciled = 0
+        for user in User.objects(UserPhone__in=phones):
+            # expired meanwhile, seeded again on demand
+            if versions.get(user.UserPhone) is None:
+                continue
+            try:
+                self.seed(user, count_unread(user), versions[user.UserPhone])
+                reconciled += 1
+            except redis.RedisError, e:
+                self.logger.error('Unable to reconcile unread counters of %s: %s' % (user.UserPhone, e))
+        return reconciled
+
+    def reconcile_once(self, interval=UNREAD_RECONCILE_INTERVAL):
+        """
+        Reconciles unless another worker has done so within the interval
+        :return: number of users reconciled or None if the run was skipped
+        """
+        if not self.redis.set(UNREAD_RECONCILE_LOCK, os.getpid(), nx=True, px=int(interval * 1000)):
+            return None
+        return self.reconcile()
+
+    def start_reconciler(self, interval=UNREAD_RECONCILE_INTERVAL):
+        """
+        Reconciles the counters periodically in a background thread, every worker may start one
+        """
+        def run():
+            while True:
+                sleep(interval)
+                try:
+                    self.reconcile_once(interval)
+                except BaseException, e:
+                    self.logger.error('Unread counters reconciliation failed: %s' % e)
+
+        reconciler = threading.Thread(target=run, name='unread-reconciler')
+        reconciler.daemon = True
+        reconciler.start()
+        return reconciler
+
+    def stats(self):
+        return {'hits': self.hits, 'seeded': self.seeded}
+
+
+unread_counters = UnreadCounters()
+
+
+def _message_saved(sender, document, created=False, **kwargs):
+    if created and document.EventId:
+        author = document.MessageAuthor
+        unread_counters.message_created(document.EventId, author.UserPhone if author is not None else None)
+
+
+def connect_signals():
+    """
+    Counts every created Message for the members of its event. Messages are created by the Api
+    processes, so it has to be called there rather than in the APNS service.
+    """
+    if signals.signals_available:
+        signals.post_save.connect(_message_saved, sender=Message)
+    else:
+        get_custom_logger().error('blinker is not installed, unread counters are only fixed by reconciliation')
+
+
+if __name__ == '__main__':
+    print 'Users reconciled: %d' % unread_counters.reconcile()
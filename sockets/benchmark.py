@@ -0,0 +1,298 @@
+"""
+Load test harness for the /ws endpoint.
+
+The socket application runs in a child process with a mocked User model and, unless --redis
+is given, an in-memory stand-in for Redis pub/sub and presence. Simulated clients run in this
+process and connect with X-User-Token headers.
+
+Usage: python -m togetherapi.sockets.benchmark --clients 5000 --concurrency 200 --messages 20000
+"""
+import argparse
+import json
+import os
+import resource
+from collections import namedtuple
+from multiprocessing import Process, Event
+from time import time
+
+from mongoengine import DoesNotExist
+from tornado import gen, ioloop, locks, web
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.websocket import websocket_connect
+
+from togetherapi.auth.cache import TokenCache
+from togetherapi.helpers import percentile
+from togetherapi.sockets import heartbeat, pubsub, weblistener, outbound
+from togetherapi.sockets.heartbeat import HeartbeatWheel
+from togetherapi.sockets.pubsub import SharedSubscriber
+
+__author__ = 'arclite'
+
+TOKEN_PREFIX = 'bench'
+
+Message = namedtuple('Message', ['kind', 'channel', 'body', 'pattern'])
+
+
+class FakePubSubClient(object):
+    """
+    In-memory stand-in for the tornadoredis client used by SharedSubscriber. Like tornadoredis it
+    records a subscription only after the command went out and its listen loop runs only while
+    something is subscribed, so a subscriber misusing the client receives nothing here either.
+    """
+
+    def __init__(self):
+        self.subscribed = set()
+        self.callback = None
+        self.exit_callback = None
+
+    def subscribe(self, channels, callback=None):
+        channels = channels if isinstance(channels, list) else [channels]
+        ioloop.IOLoop.current().add_callback(self._subscribed, channels, callback)
+
+    def _subscribed(self, channels, callback):
+        self.subscribed.update(channels)
+        if callback is not None:
+            callback(True)
+
+    def unsubscribe(self, channel, callback=None):
+        self.subscribed.discard(channel)
+        if not self.subscribed and self.callback is not None:
+            exit_callback = self.exit_callback
+            self.callback = self.exit_callback = None
+            if exit_callback is not None:
+                ioloop.IOLoop.current().add_callback(exit_callback, True)
+
+    def listen(self, callback, exit_callback=None):
+        if not self.subscribed:
+            # the loop of tornadoredis ends right away without subscriptions
+            if exit_callback is not None:
+                exit_callback(True)
+            return
+        self.callback = callback
+        self.exit_callback = exit_callback
+
+    def publish(self, channel, body):
+        if channel in self.subscribed and self.callback is not None:
+            ioloop.IOLoop.current().add_callback(self.callback, Message('message', channel, body, None))
+
+
+class NullPresence(object):
+    def connected(self, user, connection_id):
+        pass
+
+    def disconnected(self, user, connection_id):
+        pass
+
+    def refresh(self, connections):
+        pass
+
+
+class BenchUser(object):
+    class Manager(object):
+        def get(self, UserToken=None):
+            if UserToken is None or not UserToken.startswith(TOKEN_PREFIX):
+                raise DoesNotExist()
+            return BenchUser(UserToken)
+
+    objects = Manager()
+
+    def __init__(self, token):
+        self.id = token
+        self.UserToken = token
+        self.UserPhone = channel_for(token)
+        self.UserEnabled = True
+
+    def to_mongo(self):
+        return {'UserToken': self.UserToken}
+
+    @classmethod
+    def _from_son(cls, son):
+        return cls(son['UserToken'])
+
+
+class BenchTokenCache(TokenCache):
+    def _ensure_listener(self):
+        # nobody invalidates tokens during a benchmark
+        pass
+
+
+def channel_for(token):
+    return 'phone-%s' % token
+
+
+def raise_open_files_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def rss_kb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class StatsHandler(web.RequestHandler):
+    def get(self):
+        wheel = heartbeat.get_heartbeat()
+        cpu = os.times()
+        self.write({
+            'connections': len(wheel),
+            'rss_kb': rss_kb(),
+            'cpu': cpu[0] + cpu[1],
+            'rtt': list(wheel.rtt_samples),
+            'outbound': outbound.totals
+        })
+
+
+class PublishHandler(web.RequestHandler):
+    def initialize(self, publisher):
+        self.publisher = publisher
+
+    def post(self):
+        count = int(self.get_argument('count'))
+        clients = int(self.get_argument('clients'))
+        offset = int(self.get_argument('offset', 0))
+        for i in range(offset, offset + count):
+            self.publisher(channel_for('%s%d' % (TOKEN_PREFIX, i % clients)), json.dumps({'sent': time()}))
+        self.write({'published': count})
+
+
+def run_server(port, use_redis, ping_interval, ready):
+    raise_open_files_limit()
+    weblistener.User = BenchUser
+    weblistener.token_cache = BenchTokenCache(document=BenchUser)
+    if use_redis:
+        import redis
+        publisher = redis.Redis().publish
+    else:
+        client = FakePubSubClient()
+        pubsub.get_subscriber.set(SharedSubscriber(client))
+        weblistener.presence = NullPresence()
+        publisher = client.publish
+    heartbeat.get_heartbeat.set(HeartbeatWheel(interval=ping_interval))
+    application = web.Application([
+        (r'/ws', weblistener.EchoWebSocket),
+        (r'/stats', StatsHandler),
+        (r'/publish', PublishHandler, {'publisher': publisher}),
+    ])
+    application.listen(port)
+    ready.set()
+    ioloop.IOLoop.current().start()
+
+
+class LoadTest(object):
+    def __init__(self, args):
+        self.args = args
+        self.base = 'localhost:%d' % args.port
+        self.http = AsyncHTTPClient()
+        self.connections = []
+        self.latencies = []
+        self.handshake_errors = 0
+
+    @gen.coroutine
+    def stats(self):
+        response = yield self.http.fetch('http://%s/stats' % self.base)
+        raise gen.Return(json.loads(response.body))
+
+    @gen.coroutine
+    def read_loop(self, connection):
+        while True:
+            message = yield connection.read_message()
+            if message is None:
+                break
+            received = time()
+            data = json.loads(message)
+            for item in data['batch'] if isinstance(data, dict) and 'batch' in data else [data]:
+                self.latencies.append(received - item['sent'])
+
+    @gen.coroutine
+    def connect(self, index, slots):
+        yield slots.acquire()
+        try:
+            request = HTTPRequest('ws://%s/ws' % self.base, headers={'X-User-Token': '%s%d' % (TOKEN_PREFIX, index)})
+            connection = yield websocket_connect(request)
+            self.connections.append(connection)
+            self.read_loop(connection)
+        except BaseException:
+            self.handshake_errors += 1
+        finally:
+            slots.release()
+
+    @gen.coroutine
+    def run(self):
+        args = self.args
+        baseline = yield self.stats()
+
+        slots = locks.Semaphore(args.concurrency)
+        started = time()
+        yield [self.connect(i, slots) for i in range(args.clients)]
+        handshake_time = time() - started
+        connected = yield self.stats()
+
+        # let the heartbeat wheel go round a few times to collect ping/pong samples
+        yield gen.sleep(args.ping_interval * 3)
+
+        published = 0
+        started = time()
+        while published < args.messages:
+            count = min(args.batch, args.messages - published)
+            yield self.http.fetch('http://%s/publish?count=%d&clients=%d&offset=%d' % (
+                self.base, count, args.clients, published), method='POST', body='')
+            published += count
+            yield gen.sleep(max(0, started + float(published) / args.rate - time()))
+        deadline = time() + args.timeout
+        while len(self.latencies) < args.messages and time() < deadline:
+            yield gen.sleep(0.1)
+        delivered = yield self.stats()
+
+        opened = len(self.connections)
+        print 'Clients connected:        %d of %d (%d handshake errors)' % (
+            opened, args.clients, self.handshake_errors)
+        print 'Handshake rate:           %.1f/s' % (opened / handshake_time if handshake_time else 0)
+        for p in (50, 90, 99):
+            rtt = percentile(delivered['rtt'], p)
+            print 'Ping/pong RTT p%d:         %s' % (p, '%.2f ms' % (rtt * 1000) if rtt is not None else 'n/a')
+        print 'Messages received:        %d of %d' % (len(self.latencies), args.messages)
+        for p in (50, 90, 99):
+            latency = percentile(self.latencies, p)
+            print 'Publish->receive p%d:      %s' % (p, '%.2f ms' % (latency * 1000) if latency is not None else 'n/a')
+        if opened:
+            print 'Memory per connection:    %.1f KB' % (float(connected['rss_kb'] - baseline['rss_kb']) / opened)
+        if self.latencies:
+            print 'CPU per 1k messages:      %.1f ms' % (
+                (delivered['cpu'] - connected['cpu']) * 1000 * 1000 / len(self.latencies))
+        print 'Outbound queues:          %s' % delivered['outbound']
+
+        for connection in self.connections:
+            connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of the /ws endpoint')
+    parser.add_argument('--port', type=int, default=8899)
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100, help='handshakes in flight')
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--rate', type=float, default=5000, help='published messages per second')
+    parser.add_argument('--batch', type=int, default=100, help='messages published per request')
+    parser.add_argument('--ping-interval', type=float, default=1)
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for deliveries')
+    parser.add_argument('--redis', action='store_true', help='use a local Redis instead of the in-memory stand-in')
+    args = parser.parse_args()
+
+    raise_open_files_limit()
+    ready = Event()
+    server = Process(target=run_server, args=(args.port, args.redis, args.ping_interval, ready))
+    server.start()
+    try:
+        ready.wait(10)
+        ioloop.IOLoop.current().run_sync(LoadTest(args).run)
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
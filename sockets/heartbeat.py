@@ -0,0 +1,93 @@
+from collections import deque
+
+from tornado import ioloop
+
+from togetherapi import settings
+from togetherapi.helpers import per_process
+from togetherapi.utils import get_custom_logger
+
+__author__ = 'arclite'
+
+HEARTBEAT_INTERVAL = getattr(settings, 'SOCKET_HEARTBEAT_INTERVAL', 5)
+HEARTBEAT_SLOTS = getattr(settings, 'SOCKET_HEARTBEAT_SLOTS', 50)
+HEARTBEAT_MAX_MISSED = getattr(settings, 'SOCKET_HEARTBEAT_MAX_MISSED', 5)
+
+
+class HeartbeatWheel(object):
+    def __init__(self, interval=HEARTBEAT_INTERVAL, slots=HEARTBEAT_SLOTS, max_missed=HEARTBEAT_MAX_MISSED):
+        """
+        Timing wheel pinging every registered connection once per interval from a single IOLoop timer.
+        Connections are spread over the slots so each tick only pings a small batch of them.
+        :param interval: seconds between two pings of the same connection
+        :param slots: number of wheel slots, the wheel advances by one slot every interval / slots
+        :param max_missed: number of unanswered pings after which the peer is considered dead
+        """
+        self.interval = interval
+        self.max_missed = max_missed
+        self.slots = [set() for _ in range(slots)]
+        self.position = 0
+        self.pings = 0
+        self.dropped = 0
+        self.logger = get_custom_logger()
+        self.listeners = []
+        self.rtt_samples = deque(maxlen=10000)
+        self._next_slot = 0
+        self._slot_of = {}
+        self._timer = None
+
+    def register(self, connection):
+        if connection in self._slot_of:
+            return
+        # round robin placement keeps the slots evenly filled
+        slot = self._next_slot
+        self._next_slot = (self._next_slot + 1) % len(self.slots)
+        self.slots[slot].add(connection)
+        self._slot_of[connection] = slot
+        if self._timer is None:
+            self._timer = ioloop.PeriodicCallback(self._tick, self.interval * 1000.0 / len(self.slots))
+            self._timer.start()
+
+    def unregister(self, connection):
+        slot = self._slot_of.pop(connection, None)
+        if slot is not None:
+            self.slots[slot].discard(connection)
+
+    def add_listener(self, callback):
+        """
+        Registers a callback receiving, on every tick, the connections of the slot which answered their last ping
+        """
+        if callback not in self.listeners:
+            self.listeners.append(callback)
+
+    def record_rtt(self, seconds):
+        self.rtt_samples.append(seconds)
+
+    def connections(self):
+        return list(self._slot_of)
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def _tick(self):
+        slot = self.slots[self.position]
+        self.position = (self.position + 1) % len(self.slots)
+        alive = [connection for connection in slot if connection.ping_count == 0]
+        for connection in list(slot):
+            if connection.ping_count >= self.max_missed:
+                self.unregister(connection)
+                self.dropped += 1
+                self.logger.debug('Peer missed %d pongs, closing connection' % connection.ping_count)
+                connection.on_heartbeat_timeout()
+                continue
+            try:
+                connection.heartbeat()
+                self.pings += 1
+            except BaseException, e:
+                self.logger.debug("Can't ping remote host: %s" % e)
+                self.unregister(connection)
+        if alive:
+            for listener in self.listeners:
+                listener(alive)
+
+
+get_heartbeat = per_process(HeartbeatWheel)
@@ -0,0 +1,127 @@
+from collections import deque
+
+from tornado import ioloop
+from tornado.websocket import WebSocketClosedError
+
+from togetherapi import settings
+from togetherapi.utils import get_custom_logger
+
+__author__ = 'arclite'
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_DROP_CONNECTION = 'drop_connection'
+POLICY_LATEST = 'latest'
+
+OUTBOUND_MAX_MESSAGES = getattr(settings, 'SOCKET_OUTBOUND_MAX_MESSAGES', 256)
+OUTBOUND_MAX_BYTES = getattr(settings, 'SOCKET_OUTBOUND_MAX_BYTES', 1024 * 1024)
+OUTBOUND_POLICY = getattr(settings, 'SOCKET_OUTBOUND_POLICY', POLICY_DROP_OLDEST)
+# messages queued while a frame is being written are sent as one {"batch": [...]} frame,
+# clients must understand the envelope before this is switched on
+OUTBOUND_COALESCE = getattr(settings, 'SOCKET_OUTBOUND_COALESCE', False)
+
+# process wide counters over every outbound queue
+totals = {
+    'messages': 0,
+    'frames': 0,
+    'dropped_messages': 0,
+    'dropped_connections': 0
+}
+
+
+class OutboundQueue(object):
+    def __init__(self, connection, max_messages=OUTBOUND_MAX_MESSAGES, max_bytes=OUTBOUND_MAX_BYTES,
+                 policy=OUTBOUND_POLICY, coalesce=OUTBOUND_COALESCE):
+        """
+        Bounded queue of messages waiting to be written to a websocket. A single frame is in
+        flight at a time, so a slow client fills this queue instead of Tornado's write buffer.
+        :param connection: websocket handler, `on_slow_consumer` is called when it gets dropped
+        :param policy: what happens when the queue is full: drop_oldest discards the oldest queued
+        messages, latest keeps only the newest message and drop_connection closes the socket
+        """
+        self.connection = connection
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.coalesce = coalesce
+        self.pending = deque()
+        self.bytes = 0
+        self.high_water = 0
+        self.dropped = 0
+        self.frames = 0
+        self.logger = get_custom_logger()
+        self._writing = False
+        self._closed = False
+
+    def put(self, message):
+        if self._closed:
+            return False
+        size = len(message)
+        if len(self.pending) + 1 > self.max_messages or self.bytes + size > self.max_bytes:
+            if self.policy == POLICY_DROP_CONNECTION:
+                self.logger.debug('Outbound queue overflow, dropping slow consumer')
+                totals['dropped_connections'] += 1
+                self.close()
+                self.connection.on_slow_consumer()
+                return False
+            elif self.policy == POLICY_LATEST:
+                self._drop(len(self.pending))
+            else:
+                while self.pending and (len(self.pending) + 1 > self.max_messages or
+                                        self.bytes + size > self.max_bytes):
+                    self._drop(1)
+        self.pending.append(message)
+        self.bytes += size
+        self.high_water = max(self.high_water, len(self.pending))
+        totals['messages'] += 1
+        self._flush()
+        return True
+
+    def close(self):
+        self._closed = True
+        self.pending.clear()
+        self.bytes = 0
+
+    def stats(self):
+        return {
+            'queued_messages': len(self.pending),
+            'queued_bytes': self.bytes,
+            'high_water': self.high_water,
+            'dropped': self.dropped,
+            'frames': self.frames
+        }
+
+    def _drop(self, count):
+        for _ in range(count):
+            self.bytes -= len(self.pending.popleft())
+        self.dropped += count
+        totals['dropped_messages'] += count
+
+    def _flush(self):
+        if self._writing or self._closed or not self.pending:
+            return
+        if self.coalesce and len(self.pending) > 1:
+            frame = '{"batch": [%s]}' % ', '.join(self.pending)
+            self.pending.clear()
+            self.bytes = 0
+        else:
+            frame = self.pending.popleft()
+            self.bytes -= len(frame)
+        try:
+            future = self.connection.write_message(frame)
+        except WebSocketClosedError:
+            self.close()
+            return
+        self.frames += 1
+        totals['frames'] += 1
+        if future is None:
+            ioloop.IOLoop.current().add_callback(self._flush)
+        else:
+            self._writing = True
+            ioloop.IOLoop.current().add_future(future, self._on_written)
+
+    def _on_written(self, future):
+        self._writing = False
+        if future.exception() is not None:
+            self.close()
+            return
+        self._flush()
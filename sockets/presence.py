@@ -0,0 +1,103 @@
+from time import time
+
+import redis
+
+from togetherapi import settings
+from togetherapi.auth.writer import user_writer
+from togetherapi.sockets.heartbeat import HEARTBEAT_INTERVAL
+from togetherapi.utils import get_custom_logger
+
+__author__ = 'arclite'
+
+# a connection stays online for one missed heartbeat
+PRESENCE_TTL = getattr(settings, 'PRESENCE_TTL', 2 * HEARTBEAT_INTERVAL + 1)
+# mirror online transitions into User.UserConnected with batched updates
+PRESENCE_WRITE_BACK = getattr(settings, 'PRESENCE_WRITE_BACK', False)
+PRESENCE_KEY = getattr(settings, 'PRESENCE_KEY', 'presence:%s')
+
+
+class PresenceTracker(object):
+    def __init__(self, client=None, ttl=PRESENCE_TTL, write_back=PRESENCE_WRITE_BACK):
+        """
+        Tracks online users in Redis. Every user owns a sorted set of its open connections
+        scored by their expiration time, so several devices are counted separately and the
+        connections of a crashed worker expire on their own.
+        :param client: redis client, a new one is created if omitted
+        :param ttl: seconds a connection stays online without being refreshed
+        :param write_back: whether online/offline transitions are written to User.UserConnected
+        """
+        self.redis = client if client is not None else redis.Redis()
+        self.ttl = ttl
+        self.write_back = write_back
+        self.logger = get_custom_logger()
+
+    def _touch(self, pipe, phone, connection_id, now):
+        key = PRESENCE_KEY % phone
+        pipe.execute_command('ZADD', key, now + self.ttl, connection_id)
+        pipe.zremrangebyscore(key, '-inf', now)
+        pipe.expire(key, int(self.ttl) + 1)
+
+    def connected(self, user, connection_id):
+        now = time()
+        pipe = self.redis.pipeline(transaction=False)
+        self._touch(pipe, user.UserPhone, connection_id, now)
+        pipe.zcard(PRESENCE_KEY % user.UserPhone)
+        try:
+            count = pipe.execute()[-1]
+        except redis.RedisError, e:
+            self.logger.error('Unable to register presence of %s: %s' % (user.UserPhone, e))
+            return None
+        if self.write_back and count == 1:
+            user_writer.update(user, 'UserConnected', True)
+        return count
+
+    def disconnected(self, user, connection_id):
+        key = PRESENCE_KEY % user.UserPhone
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.zrem(key, connection_id)
+        pipe.zremrangebyscore(key, '-inf', time())
+        pipe.zcard(key)
+        try:
+            count = pipe.execute()[-1]
+        except redis.RedisError, e:
+            self.logger.error('Unable to unregister presence of %s: %s' % (user.UserPhone, e))
+            return None
+        if self.write_back and count == 0:
+            user_writer.update(user, 'UserConnected', False)
+        return count
+
+    def refresh(self, connections):
+        """
+        Extends the lifetime of live connections in one round trip
+        :param connections: iterable of (phone, connection_id) pairs
+        """
+        now = time()
+        pipe = self.redis.pipeline(transaction=False)
+        for phone, connection_id in connections:
+            self._touch(pipe, phone, connection_id, now)
+        if len(pipe):
+            try:
+                pipe.execute()
+            except redis.RedisError, e:
+                self.logger.error('Unable to refresh presence: %s' % e)
+
+    def connection_count(self, phone):
+        return self.redis.zcount(PRESENCE_KEY % phone, time(), '+inf')
+
+    def is_online(self, phone):
+        return self.connection_count(phone) > 0
+
+    def online(self, phones):
+        """
+        Bulk presence query
+        :return: dict mapping every phone to its online state
+        """
+        phones = list(phones)
+        now = time()
+        pipe = self.redis.pipeline(transaction=False)
+        for phone in phones:
+            pipe.zcount(PRESENCE_KEY % phone, now, '+inf')
+        return dict((phone, count > 0) for phone, count in zip(phones, pipe.execute()))
+
+
+presence = PresenceTracker()
@@ -0,0 +1,64 @@
+from collections import deque
+from time import time
+
+import redis
+
+from togetherapi import settings
+from togetherapi.helpers import per_process, percentile
+from togetherapi.sockets import replay
+from togetherapi.utils import get_custom_logger
+
+__author__ = 'arclite'
+
+PUBLISHER_POOL_SIZE = getattr(settings, 'PUBLISHER_POOL_SIZE', 10)
+PUBLISHER_POOL_TIMEOUT = getattr(settings, 'PUBLISHER_POOL_TIMEOUT', 5)
+
+
+class ChannelPublisher(object):
+    def __init__(self, pool_size=PUBLISHER_POOL_SIZE, pool_timeout=PUBLISHER_POOL_TIMEOUT):
+        """
+        Thread-safe publisher of socket channel messages sharing a bounded pool of Redis connections
+        :param pool_size: maximum number of connections, callers wait for a free one beyond it
+        :param pool_timeout: seconds to wait for a free connection
+        """
+        self.pool = redis.BlockingConnectionPool(max_connections=pool_size, timeout=pool_timeout)
+        self.redis = redis.Redis(connection_pool=self.pool)
+        self.logger = get_custom_logger()
+        self.published = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=10000)
+
+    def publish(self, channel, message):
+        return self.publish_many([(channel, message)])[0]
+
+    def publish_many(self, messages):
+        """
+        Publishes several messages in a single round trip
+        :param messages: list of (channel, message) pairs
+        :return: list of results, the number of receivers or the stream id in replay mode
+        """
+        started = time()
+        pipe = self.redis.pipeline(transaction=False)
+        for channel, message in messages:
+            replay.publish(channel, message, pipe=pipe)
+        try:
+            results = pipe.execute()
+            self.published += len(messages)
+            return results
+        except redis.RedisError:
+            self.failed += len(messages)
+            raise
+        finally:
+            self.latencies.append(time() - started)
+
+    def stats(self):
+        latencies = list(self.latencies)
+        return {
+            'published': self.published,
+            'failed': self.failed,
+            'latency_p50': percentile(latencies, 50),
+            'latency_p99': percentile(latencies, 99)
+        }
+
+
+get_publisher = per_process(ChannelPublisher)
@@ -0,0 +1,137 @@
+from collections import defaultdict
+
+import tornadoredis
+from tornado import ioloop
+
+from togetherapi import settings
+from togetherapi.helpers import per_process
+from togetherapi.utils import get_custom_logger
+
+__author__ = 'arclite'
+
+# delay before resubscribing after the connection was lost, doubled on every failed attempt
+PUBSUB_RECONNECT_DELAY = getattr(settings, 'PUBSUB_RECONNECT_DELAY', 0.5)
+PUBSUB_RECONNECT_MAX_DELAY = getattr(settings, 'PUBSUB_RECONNECT_MAX_DELAY', 30)
+
+
+class SharedSubscriber(object):
+    def __init__(self, client=None, client_factory=tornadoredis.Client):
+        """
+        Multiplexes the channel subscriptions of every socket in the process over one Redis connection.
+        When the connection is lost a new one is opened and every channel with local handlers is resubscribed.
+        :param client: tornadoredis compatible client, a new connection is opened if omitted
+        :param client_factory: opens the connections replacing lost ones
+        """
+        self.client_factory = client_factory
+        self.redis = client if client is not None else client_factory()
+        self.handlers = defaultdict(set)
+        self.logger = get_custom_logger()
+        self.reconnect_delay = PUBSUB_RECONNECT_DELAY
+        self.reconnecting = False
+        self.starting = False
+        self.listening = False
+
+    @property
+    def is_subscribed(self):
+        return bool(self.redis.subscribed)
+
+    def subscribe(self, channel, handler):
+        handlers = self.handlers[channel]
+        if handler in handlers:
+            return
+        handlers.add(handler)
+        # the Redis subscription is shared by every local handler of the channel
+        if len(handlers) == 1 and not self.reconnecting:
+            self._subscribe(channel)
+
+    def unsubscribe(self, channel, handler):
+        handlers = self.handlers.get(channel)
+        if not handlers or handler not in handlers:
+            return
+        handlers.discard(handler)
+        if not handlers:
+            del self.handlers[channel]
+            if not self.reconnecting:
+                self.redis.unsubscribe(channel)
+
+    def subscriber_count(self, channel):
+        return len(self.handlers.get(channel, ()))
+
+    def on_message(self, msg):
+        if not msg:
+            return
+        if msg.kind == 'disconnect':
+            # tornadoredis ends the listen loop after reporting the lost connection
+            self.starting = self.listening = False
+            self._schedule_resubscribe()
+            return
+        if msg.kind == 'subscribe':
+            self.reconnect_delay = PUBSUB_RECONNECT_DELAY
+        if msg.kind != 'message':
+            return
+        for handler in list(self.handlers.get(msg.channel, ())):
+            try:
+                handler.push(msg.body)
+            except BaseException, e:
+                self.logger.error('Unable to push message to channel %s: %s' % (msg.channel, e))
+
+    def _subscribe(self, channels):
+        if self.listening:
+            self.redis.subscribe(channels)
+        elif not self.starting:
+            # tornadoredis loops in listen() only while it holds a subscription, which it records once the
+            # SUBSCRIBE command is sent, so the loop is started from the callback rather than right away
+            self.starting = True
+            channels = channels if isinstance(channels, list) else [channels]
+            self.redis.subscribe(channels, callback=lambda *args: self._listen(channels))
+
+    def _listen(self, subscribed):
+        self.starting = False
+        self.listening = True
+        client = self.redis
+        self.redis.listen(self.on_message, lambda *args: self._listen_stopped(client))
+        # channels added while the first SUBSCRIBE was on its way were left for the loop
+        late = [channel for channel in self.handlers if channel not in subscribed]
+        if late:
+            self.redis.subscribe(late)
+
+    def _listen_stopped(self, client):
+        # the loop ends once the last channel is unsubscribed, or along with a client replaced on reconnect
+        if client is not self.redis:
+            return
+        self.listening = False
+        # a channel subscribed while the last one was being unsubscribed has nobody reading its messages
+        if self.handlers and not self.reconnecting:
+            self._subscribe(list(self.handlers))
+
+    def _schedule_resubscribe(self):
+        if self.reconnecting:
+            return
+        self.reconnecting = True
+        self.logger.error('Shared subscriber lost its Redis connection, resubscribing %d channels in %.1fs'
+                          % (len(self.handlers), self.reconnect_delay))
+        ioloop.IOLoop.current().call_later(self.reconnect_delay, self._resubscribe)
+        self.reconnect_delay = min(self.reconnect_delay * 2, PUBSUB_RECONNECT_MAX_DELAY)
+
+    def _resubscribe(self):
+        self.reconnecting = False
+        self.starting = False
+        self.listening = False
+        try:
+            self.redis.disconnect()
+        except BaseException:
+            pass
+        self.redis = self.client_factory()
+        # messages published in between are lost, replay mode lets clients catch up on reconnect
+        channels = list(self.handlers)
+        if not channels:
+            return
+        try:
+            self._subscribe(channels)
+        except BaseException, e:
+            self.logger.error('Unable to resubscribe: %s' % e)
+            self._schedule_resubscribe()
+
+
+# socket server workers are forked, the connection must never be shared with the parent
+get_subscriber = per_process(SharedSubscriber)
@@ -0,0 +1,73 @@
+import json
+
+import redis
+
+from togetherapi import settings
+
+__author__ = 'arclite'
+
+# record every channel message in a capped stream so reconnecting clients can catch up
+REPLAY_ENABLED = getattr(settings, 'SOCKET_REPLAY_ENABLED', False)
+REPLAY_MAXLEN = getattr(settings, 'SOCKET_REPLAY_MAXLEN', 100)
+REPLAY_TTL = getattr(settings, 'SOCKET_REPLAY_TTL', 24 * 60 * 60)
+REPLAY_STREAM_KEY = getattr(settings, 'SOCKET_REPLAY_STREAM_KEY', 'replay:%s')
+REPLAY_HEADER = 'X-Last-Event-Id'
+
+# appends the message to the stream and publishes it wrapped with its stream id in one round trip
+_PUBLISH_SCRIPT = """
+local sid = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'm', ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('PUBLISH', ARGV[4], '{"sid": "' .. sid .. '", "data": ' .. ARGV[3] .. '}')
+return sid
+"""
+
+client = redis.Redis()
+_publish_script = client.register_script(_PUBLISH_SCRIPT)
+
+
+def publish(channel, message, pipe=None):
+    """
+    Publishes a JSON encoded message to a socket channel. In replay mode the message is also
+    appended to the channel stream and delivered as {"sid": <stream id>, "data": <message>}.
+    :param pipe: pipeline to queue the commands on instead of sending them right away
+    """
+    target = pipe if pipe is not None else client
+    if not REPLAY_ENABLED:
+        return target.publish(channel, message)
+    return _publish_script(keys=[REPLAY_STREAM_KEY % channel],
+                           args=[REPLAY_MAXLEN, REPLAY_TTL, message, channel], client=target)
+
+
+def parse_sid(sid):
+    ms, seq = sid.split('-')
+    return int(ms), int(seq)
+
+
+def envelope_sid(envelope):
+    try:
+        return parse_sid(json.loads(envelope)['sid'])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def read_since(channel, last_id, limit=REPLAY_MAXLEN):
+    """
+    Reads the messages a client has missed
+    :param last_id: stream id of the last message the client has seen
+    :return: (complete, envelopes) where complete is False when older messages were trimmed
+    or expired in between, in which case the client has to refetch its state
+    """
+    try:
+        parse_sid(last_id)
+    except ValueError:
+        return False, []
+    # XRANGE is inclusive, the last seen entry itself tells whether the history is intact
+    entries = client.xrange(REPLAY_STREAM_KEY % channel, last_id, '+', count=limit + 2)
+    complete = bool(entries) and entries[0][0] == last_id and len(entries) <= limit + 1
+    entries = entries[:limit + 1]
+    envelopes = []
+    for sid, fields in entries:
+        if sid == last_id:
+            continue
+        envelopes.append('{"sid": "%s", "data": %s}' % (sid, fields['m']))
+    return complete, envelopes
@@ -1,53 +1,136 @@
 import json
+import os
+import signal
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from multiprocessing import Process
 from struct import *
 from time import time
 
 import tornado
-import tornadoredis
 from mongoengine import DoesNotExist
-from tornado import websocket, httpserver, ioloop, web
-from tornadoredis.pubsub import SocketIOSubscriber
+from tornado import websocket, httpserver, ioloop, web, gen, locks
+from tornado.netutil import bind_sockets
 
 from Api.models import User
+from togetherapi import settings
+from togetherapi.auth.cache import token_cache
 from togetherapi.settings import DEBUG
 from togetherapi.sockets import LISTEN, PROD_LISTEN
-from togetherapi.utils import singleton, get_custom_logger, backgroundExec
+from togetherapi.sockets.heartbeat import get_heartbeat
+from togetherapi.sockets.outbound import OutboundQueue
+from togetherapi.sockets.presence import presence
+from togetherapi.sockets.pubsub import get_subscriber
+from togetherapi.sockets.replay import REPLAY_ENABLED, REPLAY_HEADER, read_since, envelope_sid
+from togetherapi.utils import singleton, get_custom_logger
 
 __author__ = 'arclite'
 
+SOCKET_WORKERS = getattr(settings, 'SOCKET_WORKERS', 1)
+# every worker binds its own SO_REUSEPORT listener instead of sharing one bound before forking
+SOCKET_REUSE_PORT = getattr(settings, 'SOCKET_REUSE_PORT', False)
+SOCKET_SUPERVISE_INTERVAL = getattr(settings, 'SOCKET_SUPERVISE_INTERVAL', 1)
+SOCKET_SHUTDOWN_GRACE = getattr(settings, 'SOCKET_SHUTDOWN_GRACE', 5)
+# a worker dying right after its start is restarted with a doubling delay, one which survived
+# SOCKET_RESTART_RESET seconds is considered healthy again
+SOCKET_RESTART_MAX_DELAY = getattr(settings, 'SOCKET_RESTART_MAX_DELAY', 60)
+SOCKET_RESTART_RESET = getattr(settings, 'SOCKET_RESTART_RESET', 60)
+SOCKET_HANDSHAKE_CONCURRENCY = getattr(settings, 'SOCKET_HANDSHAKE_CONCURRENCY', 16)
+SOCKET_HANDSHAKE_TIMEOUT = getattr(settings, 'SOCKET_HANDSHAKE_TIMEOUT', 10)
+
+# threads are started lazily, so every forked worker gets its own
+handshake_executor = ThreadPoolExecutor(SOCKET_HANDSHAKE_CONCURRENCY)
+handshake_slots = locks.Semaphore(SOCKET_HANDSHAKE_CONCURRENCY)
+presence_executor = ThreadPoolExecutor(1)
+
 
 class EchoWebSocket(websocket.WebSocketHandler):
-    @backgroundExec(5)
-    def poll(self):
-        if self.ping_count >= 5:
-            self.on_close()
-        try:
-            if not self.syncValue:
-                self.renew_sync()
-            bin_data = pack("%ds" % len(self.syncValue), self.syncValue)
-            self.ping(bin_data)
-            self.ping_count += 1
-            self.logger.debug("Ping remote host with payload: %s", self.syncValue)
-        except BaseException, ex:
-            # self.logger.error("Can't ping remote host: %s", ex.message)
-            self.poller_kill_handler.set()
+    def heartbeat(self):
+        if not self.syncValue:
+            self.renew_sync()
+        bin_data = pack("%ds" % len(self.syncValue), self.syncValue)
+        self.ping(bin_data)
+        self.ping_sent = time()
+        self.ping_count += 1
+        self.logger.debug("Ping remote host with payload: %s", self.syncValue)
+
+    def on_heartbeat_timeout(self):
+        self.on_close()
+        self.close()
 
     def __init__(self, application, request, **kwargs):
         super(EchoWebSocket, self).__init__(application, request, **kwargs)
         self.logger = get_custom_logger()
         self.user = None
-        self.pubsub = SocketIOSubscriber(tornadoredis.Client())
+        self.pubsub = get_subscriber()
+        self.subscribed = False
         self.ping_count = 0
         self.payload = None
         self.syncValue = None
-        self.poller_kill_handler = None
+        self.ping_sent = None
+        self.heartbeat_wheel = get_heartbeat()
+        self.connection_id = uuid.uuid4().hex
+        self.outbound = OutboundQueue(self)
+        self.replay_buffer = None
+
+    @gen.coroutine
+    def prepare(self):
+        token = self.request.headers.get("X-User-Token")
+        self.logger.debug("Token present:%s" % token)
+        if token is None or token_cache.is_unknown(token):
+            raise web.HTTPError(403)
+        user = token_cache.get_user(token)
+        if user is None:
+            # database lookups run off the IOLoop so a reconnect storm does not stall the open sockets
+            try:
+                yield handshake_slots.acquire(timeout=timedelta(seconds=SOCKET_HANDSHAKE_TIMEOUT))
+            except gen.TimeoutError:
+                raise web.HTTPError(503)
+            try:
+                user = yield handshake_executor.submit(self._authenticate, token)
+            finally:
+                handshake_slots.release()
+        if user is None:
+            raise web.HTTPError(403)
+        self.user = user
+        self.channel = user.UserPhone
+
+    def _presence_changed(self, connected):
+        # a single thread keeps the connect and disconnect of a socket in order
+        if connected:
+            presence_executor.submit(presence.connected, self.user, self.connection_id)
+        else:
+            presence_executor.submit(presence.disconnected, self.user, self.connection_id)
+
+    @staticmethod
+    def _authenticate(token):
+        invalidations = token_cache.invalidations
+        try:
+            user = User.objects.get(UserToken=token)
+            token_cache.set_user(token, user)
+            return user
+        except DoesNotExist:
+            token_cache.remember_unknown(token, invalidations)
+            return None
 
     def open(self):
         self.stream.set_nodelay(True)
         # self.logger.debug("WebSocket opened")
         self.payload = self.channel
-        self.poller_kill_handler = self.poll()
+        last_id = self.request.headers.get(REPLAY_HEADER) or self.get_argument('last_id', None)
+        if REPLAY_ENABLED and last_id:
+            # live messages are held back until the missed ones have been sent
+            self.replay_buffer = []
+            self.sub()
+            future = handshake_executor.submit(read_since, self.channel, last_id)
+            ioloop.IOLoop.current().add_future(future, self._on_replay)
+        else:
+            self.sub()
+        self._presence_changed(True)
+        self.heartbeat_wheel.add_listener(refresh_presence)
+        self.heartbeat_wheel.register(self)
 
     def on_message(self, message):
         try:
@@ -58,17 +141,44 @@ class EchoWebSocket(websocket.WebSocketHandler):
 
     def sub(self):
         self.pubsub.subscribe(self.channel, self)
+        self.subscribed = True
+
+    def push(self, message):
+        if self.replay_buffer is not None:
+            self.replay_buffer.append(message)
+        else:
+            self.outbound.put(message)
+
+    def _on_replay(self, future):
+        buffered, self.replay_buffer = self.replay_buffer, None
+        try:
+            complete, envelopes = future.result()
+        except BaseException, e:
+            self.logger.error("Replay for channel %s failed: %s" % (self.channel, e))
+            complete, envelopes = False, []
+        for envelope in envelopes:
+            self.outbound.put(envelope)
+        self.outbound.put(json.dumps({'replay': {'complete': complete, 'count': len(envelopes)}}))
+        last_sid = envelope_sid(envelopes[-1]) if envelopes else None
+        for message in buffered:
+            sid = envelope_sid(message)
+            if last_sid is None or sid is None or sid > last_sid:
+                self.outbound.put(message)
+
+    def on_slow_consumer(self):
+        self.logger.debug("Client on channel %s can not keep up, closing connection" % self.channel)
+        self.on_close()
+        self.close()
 
     def renew_sync(self):
         self.syncValue = str(int(time())).encode('utf-8')
         self.logger.debug("Sync value set: %s for channel %s." % (self.syncValue, self.channel))
 
     def unsub(self):
-        if self.pubsub.is_subscribed:
+        if self.subscribed:
+            self.subscribed = False
             self.pubsub.unsubscribe(self.channel, self)
-            self.pubsub.close()
-            self.user.UserConnected = False
-            self.user.save()
+            self._presence_changed(False)
             self.logger.debug("Client unsubscribed")
 
     def on_pong(self, data):
@@ -76,6 +186,8 @@ class EchoWebSocket(websocket.WebSocketHandler):
             if data == self.syncValue:
                 self.logger.debug("Ping ok: %s - connection is sync." % data)
                 self.ping_count = 0
+                if self.ping_sent is not None:
+                    self.heartbeat_wheel.record_rtt(time() - self.ping_sent)
                 self.renew_sync()
             else:
                 self.logger.error(
@@ -92,26 +204,21 @@ class EchoWebSocket(websocket.WebSocketHandler):
         self.on_close()
 
     def on_close(self):
+        self.heartbeat_wheel.unregister(self)
+        self.outbound.close()
         try:
             self.unsub()
-            self.poller_kill_handler.set()
         except AttributeError:
             pass
             # self.logger.debug("WebSocket closed")
 
     def check_origin(self, origin):
-        token = self.request.headers.get("X-User-Token")
-        self.logger.debug("Token present:%s" % token)
-        try:
-            u = User.objects.get(UserToken=token)
-            u.UserConnected = True
-            u.save()
-            self.user = u
-            self.channel = u.UserPhone
-            self.sub()
-            return True
-        except DoesNotExist:
-            return False
+        # the token has already been verified by prepare()
+        return self.user is not None
+
+
+def refresh_presence(connections):
+    presence_executor.submit(presence.refresh, [(c.channel, c.connection_id) for c in connections])
 
 
 application = tornado.web.Application([
@@ -122,26 +229,98 @@ application = tornado.web.Application([
 @singleton
 class SocketServerRunner:
     def __init__(self):
-        self.proc_handler = None
+        self.workers = {}
+        self.started = {}
+        self.failures = {}
+        self.restart_at = {}
+        self.sockets = None
+        self.supervisor = None
+        self.stopping = threading.Event()
         self.logger = get_custom_logger()
         self.logger.debug('Socket server runner initialized')
 
     def _proc_runner(self):
-        http_server = tornado.httpserver.HTTPServer(application, ssl_options=None)
-        if DEBUG:
-            http_server.listen(LISTEN)
+        http_server = httpserver.HTTPServer(application, ssl_options=None)
+        if self.sockets is not None:
+            http_server.add_sockets(self.sockets)
         else:
-            http_server.listen(PROD_LISTEN)
+            http_server.add_sockets(bind_sockets(LISTEN if DEBUG else PROD_LISTEN, reuse_port=True))
+        loop = ioloop.IOLoop.instance()
+        signal.signal(signal.SIGTERM,
+                      lambda signum, frame: loop.add_callback_from_signal(self._shutdown, http_server, loop))
         try:
-            ioloop.IOLoop.instance().start()
+            loop.start()
         except Exception:
             pass
 
-    def run_server(self):
-        p = Process(target=self._proc_runner)
-        self.proc_handler = p
+    def _shutdown(self, http_server, loop):
+        http_server.stop()
+        # clients reconnect to the remaining workers, pending deliveries are routed by Redis channels
+        for connection in get_heartbeat().connections():
+            connection.on_heartbeat_timeout()
+        loop.call_later(SOCKET_SHUTDOWN_GRACE, loop.stop)
+
+    def _spawn(self, index):
+        p = Process(target=self._proc_runner, name='socket-worker-%d' % index)
+        self.workers[index] = p
+        self.started[index] = time()
         p.start()
 
+    def _supervise(self):
+        while not self.stopping.wait(SOCKET_SUPERVISE_INTERVAL):
+            now = time()
+            for index, p in self.workers.items():
+                if p.is_alive() or self.stopping.is_set():
+                    continue
+                if index not in self.restart_at:
+                    if now - self.started[index] < SOCKET_RESTART_RESET:
+                        self.failures[index] = self.failures.get(index, 0) + 1
+                    else:
+                        self.failures[index] = 1
+                    delay = min(SOCKET_SUPERVISE_INTERVAL * 2 ** (self.failures[index] - 1), SOCKET_RESTART_MAX_DELAY)
+                    self.restart_at[index] = now + delay
+                    self.logger.error('Socket worker %d exited with code %s, restarting in %ds'
+                                      % (index, p.exitcode, delay))
+                elif now >= self.restart_at[index]:
+                    del self.restart_at[index]
+                    self._spawn(index)
+
+    def run_server(self, workers=SOCKET_WORKERS):
+        """
+        Starts the socket server workers and a thread restarting the ones which die
+        :param workers: number of worker processes, each of them runs its own IOLoop
+        """
+        if not SOCKET_REUSE_PORT:
+            # pre-fork mode, the workers accept on a listener bound once here
+            self.sockets = bind_sockets(LISTEN if DEBUG else PROD_LISTEN)
+        self.stopping.clear()
+        for index in range(workers):
+            self._spawn(index)
+        self.supervisor = threading.Thread(target=self._supervise, name='socket-workers-supervisor')
+        self.supervisor.daemon = True
+        self.supervisor.start()
+
+    def stop_server(self):
+        self.stopping.set()
+        if self.supervisor is not None:
+            self.supervisor.join()
+        for p in self.workers.values():
+            if p.is_alive():
+                p.terminate()
+        for p in self.workers.values():
+            p.join(SOCKET_SHUTDOWN_GRACE + 1)
+            if p.is_alive():
+                self.logger.error('Socket worker %d did not stop in time, killing it' % p.pid)
+                os.kill(p.pid, signal.SIGKILL)
+                p.join()
+        self.workers = {}
+        self.failures = {}
+        self.restart_at = {}
+        if self.sockets is not None:
+            for sock in self.sockets:
+                sock.close()
+            self.sockets = None
+
     def __del__(self):
-        if self.proc_handler is not None:
-            self.proc_handler.join()
+        for p in self.workers.values():
+            p.join()